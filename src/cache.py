@@ -0,0 +1,180 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import typing
+from logger import logger
+from constants import *
+
+
+HASH_CHUNK_SIZE = 1024 * 1024   # bytes of an upload hashed at a time
+INFO_SUFFIX = '.json'           # {'suffixes': [...], 'page_count': ..., 'orientation': ...} of a cached conversion
+
+
+
+class ConversionCache:
+    """ Content-addressed store of the normalized files, shared by all the entries. The key
+        of an upload is the hash of its bytes, its type and the settings the conversion
+        depends on, so a file uploaded again (to any entry) is not converted again.
+        The artifacts of a conversion (the '.1' file and its sidecars, named by their suffix
+        after the upload name) are hard-linked between the cache and the entry dirs, the
+        bytes are stored once. Used by the conversion workers of both the webserver and the
+        kiosk, so everything is done with atomic file operations. The least recently used
+        conversions are evicted past the budget, by the mtime of their info file.
+    """
+
+    def __init__(self, cache_dir:str = CACHE_FPATH, budget:int = CACHE_BUDGET):
+        self.cache_dir:str = cache_dir
+        self.budget:int = budget
+        self._lock = threading.Lock()
+
+
+    def key(self, f_path:str) -> str:
+
+        digest = hashlib.sha256()
+        with open(f_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+        # the conversion of the images depends on these
+        ext = os.path.splitext(f_path)[1][1:].lower()
+        digest.update(f'{ext}:{IMAGE_PRINT_DPI}:{IMAGE_JPEG_QUALITY}'.encode())
+
+        return digest.hexdigest()
+
+
+    def fetch(self, key:str, entry_dir:str, file:str) -> typing.Optional[dict]:
+        """ Links the cached artifacts next to the upload. Returns the info of the
+            conversion, or None on a miss.
+        """
+
+        info_f_path = os.path.join(self.cache_dir, key + INFO_SUFFIX)
+        linked = []
+
+        try:
+            with open(info_f_path) as f:
+                info = json.load(f)
+
+            for suffix in info['suffixes']:
+                dst = os.path.join(entry_dir, file + suffix)
+                self._link(os.path.join(self.cache_dir, key + suffix), dst)
+                linked.append(dst)
+
+            # marks it as recently used
+            os.utime(info_f_path)
+
+        except (OSError, ValueError, KeyError) as e:
+            # not cached, or evicted while being linked
+            if linked or not isinstance(e, FileNotFoundError):
+                logger.debug(f'Cached conversion {key[:12]} unusable -> {repr(e)}')
+            for dst in linked:
+                os.remove(dst)
+            return None
+
+        logger.debug(f'Conversion of \'{file}\' found in the cache ({key[:12]})')
+        return info
+
+
+    def store(self, key:str, entry_dir:str, file:str, suffixes:typing.List[str], **info) -> None:
+        """ Adds the artifacts of a conversion (the upload name + each suffix) to the cache.
+        """
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+            for suffix in suffixes:
+                self._link(os.path.join(entry_dir, file + suffix), os.path.join(self.cache_dir, key + suffix))
+
+            # written last, a conversion without its info file is not visible
+            tmp_f_path = os.path.join(self.cache_dir, f'{key}.{os.getpid()}.tmp')
+            with open(tmp_f_path, 'w') as f:
+                json.dump(dict(info, suffixes=suffixes), f)
+            os.replace(tmp_f_path, os.path.join(self.cache_dir, key + INFO_SUFFIX))
+
+        except OSError as e:
+            # the cache is an optimization, a full SD card must not fail the conversion
+            logger.info(f'Caching the conversion of \'{file}\' failed -> {repr(e)}')
+            return
+
+        self.evict()
+
+
+    def evict(self) -> int:
+        """ Removes the least recently used conversions until the cache fits its budget.
+            Returns the bytes freed.
+        """
+
+        with self._lock:
+            try:
+                files = [file for file in os.scandir(self.cache_dir) if file.is_file(follow_symlinks=False)]
+            except FileNotFoundError:
+                return 0
+
+            sizes, used = {}, 0
+            for file in files:
+                key = file.name.split('.', 1)[0]
+                try:
+                    size = file.stat().st_size
+                except FileNotFoundError:
+                    continue
+                sizes[key] = sizes.get(key, 0) + size
+                used += size
+
+            if used <= self.budget:
+                return 0
+
+            def last_used(key:str) -> float:
+                try:
+                    return os.stat(os.path.join(self.cache_dir, key + INFO_SUFFIX)).st_mtime
+                except FileNotFoundError:
+                    return 0.0      # orphaned artifacts go first
+
+            freed = 0
+            for key in sorted(sizes, key=last_used):
+                if used - freed <= self.budget:
+                    break
+
+                # the info file goes first, the artifacts are never visible without it
+                for file in sorted(files, key=lambda file: not file.name.endswith(INFO_SUFFIX)):
+                    if file.name.split('.', 1)[0] == key:
+                        try:
+                            os.remove(file.path)
+                        except FileNotFoundError:
+                            pass
+                freed += sizes[key]
+
+            logger.info(f'Evicted {freed} bytes of cached conversions')
+            return freed
+
+
+    def _link(self, src:str, dst:str) -> None:
+        """ Hard-links src to dst, replacing dst. Copies it where links are not supported.
+        """
+
+        # already linked, e.g. a file of the entry converted again
+        if os.path.lexists(dst) and os.path.samefile(src, dst):
+            return
+
+        tmp_f_path = f'{dst}.{os.getpid()}.tmp'
+
+        # left over by a worker that died
+        if os.path.lexists(tmp_f_path):
+            os.remove(tmp_f_path)
+
+        try:
+            os.link(src, tmp_f_path)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(src, tmp_f_path)
+
+        os.replace(tmp_f_path, dst)
+
+        # a rename onto another link of the same file does nothing
+        if os.path.lexists(tmp_f_path):
+            os.remove(tmp_f_path)
+
+
+
+conversion_cache = ConversionCache()
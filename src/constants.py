@@ -11,11 +11,52 @@ C_WIDTH = 500                   # preview tk.Canvas width
 C_HEIGHT = 500                  # preview tk.Canvas height
 W_WIDTH = 1024                  # window width
 W_HEIGHT = 600                  # window height
+PREVIEW_CACHE_BYTES = 32 * 1024 * 1024      # memory budget of the rendered preview pages
+PREFETCH_DELAY = 300            # milliseconds of idle time before the next pages are pre-rendered
+DOC_SESSIONS = 4                # docs of an entry kept open in the kiosk, the last selected ones
 
 RAND_SEQ_LENGTH = 7             # One Time Password length
+CODE_POOL_SIZE = 16             # OTPs and QR images generated ahead of the uploads
+CODE_RANDOM_BATCH = 256         # bytes read from os.urandom() at a time
+QR_FORMAT = 'png'               # 'png' or 'svg' (scales to any screen, but larger for such short codes)
+
+ENTRY_RM_INTERVAL = 1800        # seconds an uploaded user entry is kept
+ENTRY_IN_USE_RETRY = 60         # seconds an expired entry open in the kiosk is kept before it is checked again
+STORAGE_BUDGET = 2 * 1024 * 1024 * 1024     # bytes all the entries may take on the SD card
+STORAGE_UPLOAD_FACTOR = 2       # an upload is admitted for this many times its size, to leave room for its '.1' files
+
+CONVERSION_WORKERS = os.cpu_count() or 1 # processes normalizing the files, one per core
+CONVERSION_POLL_INTERVAL = 250  # milliseconds, kiosk polling of the files still being converted
+CACHE_BUDGET = 512 * 1024 * 1024    # bytes the converted files shared between the entries may take
+
+UPLOAD_MAX_FILE_SIZE = 25 * 1024 * 1024     # bytes, largest single uploaded file
+UPLOAD_MAX_ENTRY_SIZE = 60 * 1024 * 1024    # bytes, largest upload request / total size of an entry
+UPLOAD_CHUNK_SIZE = 64 * 1024   # bytes read from the upload stream at a time
+UPLOAD_SNIFF_SIZE = 2048        # bytes of each file inspected to detect its type
+
+PRINTER_BACKEND = 'lp'          # 'lp' (CUPS) or 'file' (copies the jobs to PRINT_SINK_FPATH, for testing)
+PRINTER_NAME = None             # CUPS destination, None for the default printer
+SPOOLER_POLL_INTERVAL = 500     # milliseconds, kiosk polling of the print jobs
+PRINT_GRAYSCALE_RASTER = False  # grayscale sheets are rasterized, for printers that ignore print-color-mode=monochrome
+PRINT_GRAYSCALE_DPI = 300       # resolution of the rasterized grayscale sheets
+PRINT_MERGE_JOBS = True         # the selected files with compatible options are sent as one job
+IMAGE_PRINT_DPI = 200           # larger uploaded images are resampled to this resolution on the A4 page
+IMAGE_JPEG_QUALITY = 85         # quality of the resampled JPEG photos
+
+LOW_MEMORY_MODE = False         # for 1 GB boards, MuPDF caching is limited and the page loops stay under MEMORY_CEILING
+MEMORY_CEILING = 384 * 1024 * 1024  # bytes, resident memory allowed to a process in LOW_MEMORY_MODE
+
+WEBSERVER_HOST = '0.0.0.0'
+WEBSERVER_PORT = 8080
+WEBSERVER_MODE = 'threaded'     # 'dev' (Flask dev server), 'threaded' (pool of WSGI workers) or 'waitress'
+WEBSERVER_THREADS = 8           # request workers of the 'threaded' and 'waitress' modes
+WEBSERVER_SHUTDOWN_TIMEOUT = 10 # seconds the kiosk waits for the webserver to finish before killing it
 
-ENTRY_RM_INTERVAL = 1800        # seconds, interval to delete old uploaded user entries
 ENTRIES_FPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tmp')
+REGISTRY_FPATH = os.path.join(ENTRIES_FPATH, 'entries.db')
+CACHE_FPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'cache')
+SPOOL_FPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'spool')
+PRINT_SINK_FPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'printed')
 WEBSERVER_FPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'webserver')
 
 
@@ -0,0 +1,287 @@
+import fitz_old as fitz
+import os
+import typing
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from logger import logger
+from pdftools import PDFConverter
+from registry import registry
+from storage import storage
+from cache import conversion_cache
+from preview import save_thumbnail
+from constants import *
+
+
+STATUS_PENDING = 'pending'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+
+def convert_file(entry_dir:str, file:str) -> dict:
+    """ Normalizes an uploaded file to an A4 PDF with printer margins (the '.1' file),
+        and writes the thumbnail the kiosk shows while the '.1' file is opened.
+        Returns the output name, page count and orientation of the normalized doc, and
+        whether it was found in the ConversionCache instead of being converted.
+        Arguments and result are plain types so it can run as a job in a process pool.
+    """
+
+    key = conversion_cache.key(os.path.join(entry_dir, file))
+    info = conversion_cache.fetch(key, entry_dir, file)
+
+    if info is not None:
+        return {'output': file + info['suffixes'][0],
+                'page_count': info['page_count'],
+                'orientation': info['orientation'],
+                'cached': True}
+
+    pdf_obj = PDFConverter(entry_dir, file)
+
+    try:
+        if pdf_obj.get_f_ext != 'pdf':
+            pdf_obj.convert_image_w_pmargin()
+        else:
+            pdf_obj.check_and_resize_pdf()
+    finally:
+        pdf_obj.close()
+
+    with fitz.Document(pdf_obj.output_pdf_f_path) as out:
+        page = out.load_page(0)
+        orientation = 'P' if page.rect.width <= page.rect.height else 'L'
+        page_count = out.page_count
+
+    output = os.path.basename(pdf_obj.output_pdf_f_path)
+    artifacts = [output]
+
+    try:
+        artifacts.append(save_thumbnail(entry_dir, output, page_count, orientation))
+    except Exception as e:
+        # the kiosk renders the first sheet itself
+        logger.info(f'Thumbnail of \'{output}\' failed -> {repr(e)}')
+
+    conversion_cache.store(key, entry_dir, file, [artifact[len(file):] for artifact in artifacts],
+                           page_count=page_count, orientation=orientation)
+
+    return {'output': output,
+            'page_count': page_count,
+            'orientation': orientation,
+            'cached': False}
+
+
+
+class EntryStatus:
+    """ Conversion status of the files of an entry. Kept in the entry registry
+        so that the webserver can write it and the kiosk can read it.
+    """
+
+    def __init__(self, entry_dir:str):
+        self.entry_dir:str = entry_dir
+        self.otp:str = os.path.basename(os.path.normpath(entry_dir))
+
+
+    def read(self) -> dict:
+        """ Returns the status of all the files, {} if nothing was recorded yet.
+        """
+
+        return registry.status(self.otp)
+
+
+    def get(self, file:str) -> typing.Optional[dict]:
+        return self.read().get(file)
+
+
+    def set(self, files:typing.Iterable[str], state:str, **info) -> None:
+        """ Records the same state for one or more files.
+        """
+
+        registry.set_status(self.otp, files, state, **info)
+
+
+    def discard(self, files:typing.Iterable[str]) -> None:
+        """ Forgets the status of the files, the kiosk then converts them itself.
+        """
+
+        registry.clear_status(self.otp, files)
+
+
+
+class ConversionPool:
+    """ Process pool that normalizes the files on all the cores. Used by the webserver
+        to convert the uploads in the background (recording the result in the
+        EntryStatus of each entry) and by the kiosk for the files without a status.
+    """
+
+    def __init__(self, workers:int = CONVERSION_WORKERS):
+        self.workers:int = workers
+        self.executor:ProcessPoolExecutor = None
+        self.closed:bool = False            # shut down, the jobs lost with a worker are not run again
+        self._lock = threading.Lock()
+        self.cache_hits:int = 0             # conversions found in the ConversionCache
+        self.cache_misses:int = 0
+
+
+    def mark_pending(self, entry_dir:str, files:typing.List[str]) -> None:
+        """ Must be called before the files are written to the entry dir, otherwise the
+            kiosk could find a file without a status and convert it a second time.
+        """
+
+        EntryStatus(entry_dir).set(files, STATUS_PENDING)
+
+
+    def submit(self, entry_dir:str, files:typing.List[str]) -> None:
+        """ Converts the files and records the result of each one in the EntryStatus.
+        """
+
+        status = EntryStatus(entry_dir)
+
+        for file in files:
+            future = self.convert(entry_dir, file)
+            future.add_done_callback(lambda future, file=file: self._record(status, file, future))
+
+
+    def convert(self, entry_dir:str, file:str) -> Future:
+        """ Submits a single convert_file() job. The Future resolves to its result dict.
+        """
+
+        future = self.run(convert_file, entry_dir, file)
+        future.add_done_callback(lambda future: storage.refresh(entry_dir))
+        future.add_done_callback(self._count)
+        return future
+
+
+    def run(self, fn:typing.Callable, *args) -> Future:
+        """ Runs any picklable job on the pool, e.g. the rendering of the print jobs.
+            When a worker dies (e.g. MuPDF crashed on a bad upload) every job of the pool
+            fails with BrokenProcessPool, so the pool is restarted and those jobs are run
+            once more. Only a job that fails again, or raises itself, fails its Future.
+            Cancelling the Future cancels the job if it has not started yet.
+        """
+
+        future = Future()
+        attempts = []                       # (executor, job) of each run of the job
+        self._attempt(future, attempts, fn, args)
+        future.add_done_callback(lambda future: future.cancelled() and attempts[-1][1].cancel())
+        return future
+
+
+    def stats(self) -> dict:
+        return dict(cache_hits=self.cache_hits, cache_misses=self.cache_misses)
+
+
+    def shutdown(self, wait:bool = True, cancel_futures:bool = None) -> None:
+        """ By default the queued jobs are cancelled only if the running ones are not waited for.
+        """
+
+        if cancel_futures is None:
+            cancel_futures = not wait
+
+        self.closed = True
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+            self.executor = None
+
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """ The workers are started on the first job and reused afterwards. 'spawn' is used
+            so that the workers do not inherit the threads and the Tk state of the parent.
+        """
+
+        with self._lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+
+    def _attempt(self, future:Future, attempts:list, fn:typing.Callable, args:tuple) -> None:
+
+        try:
+            executor = self._get_executor()
+            job = executor.submit(fn, *args)
+
+        except BrokenProcessPool:
+            # broken before the job got in
+            self._restart(executor)
+            executor = self._get_executor()
+            job = executor.submit(fn, *args)
+
+        attempts.append((executor, job))
+        job.add_done_callback(lambda job: self._resolve(future, attempts, fn, args))
+
+
+    def _resolve(self, future:Future, attempts:list, fn:typing.Callable, args:tuple) -> None:
+        """ Passes the outcome of the last run of the job to its Future, or runs it again.
+        """
+
+        executor, job = attempts[-1]
+
+        if job.cancelled():
+            future.cancel()
+            return
+
+        error = job.exception()
+
+        if isinstance(error, BrokenProcessPool) and len(attempts) < 2 and not self.closed:
+            self._restart(executor)
+            try:
+                if not future.cancelled():
+                    self._attempt(future, attempts, fn, args)
+                return
+            except Exception as e:
+                # the new pool could not take the job
+                error = e
+
+        # False if the Future was cancelled while the job ran
+        if not future.set_running_or_notify_cancel():
+            return
+
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(job.result())
+
+
+    def _restart(self, executor:ProcessPoolExecutor) -> None:
+        """ Drops the broken pool, once whatever the number of jobs it broke.
+        """
+
+        with self._lock:
+            if self.executor is executor:
+                logger.info('Conversion pool is broken, restarting it')
+                executor.shutdown(wait=False)
+                self.executor = None
+
+
+    def _count(self, future:Future) -> None:
+
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        if future.result()['cached'] is True:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+
+
+    def _record(self, status:EntryStatus, file:str, future:Future) -> None:
+
+        log_str = f'Background conversion of \'{file}\' ... '
+
+        if future.cancelled():
+            # the pool was shut down before the job started
+            status.discard([file])
+            logger.debug(log_str + 'Cancelled, left to the kiosk')
+            return
+
+        if future.exception() is not None:
+            status.set([file], STATUS_FAILED, error=repr(future.exception()))
+            log_str += repr(future.exception())
+
+        else:
+            status.set([file], STATUS_DONE, **future.result())
+            log_str += 'Done'
+
+        logger.debug(log_str)
@@ -1,8 +1,11 @@
 import tkinter as tk
 from tkinter import ttk
 from logger import logger
-from pdftools import PDFConverter
+from pdftools import PDFModifier
+from conversion import ConversionPool, EntryStatus, STATUS_PENDING, STATUS_DONE
 from typing import List
+import queue
+import os
 from constants import *
 
 
@@ -124,14 +127,12 @@ class ClearBtn(ttk.Button):
 class FileOptions:
     """ Stores the doc options/settings """
     
-    def __init__(self, pdf_obj:PDFConverter) -> None:
-        
-        self.pdf_obj = pdf_obj
+    def __init__(self, orientation:str) -> None:
         
         self.no_copies:int = 1
         self.color:str = 'Color'
         self.both_sides:str = 'Print both sides'
-        self.orientation:str = 'Portrait' if self.pdf_obj.get_orientation() == 'P' else 'Landscape'
+        self.orientation:str = 'Portrait' if orientation == 'P' else 'Landscape'
         # self.scale:str = '100%'
         self.layout:int = 1
 
@@ -144,17 +145,27 @@ class FileListbox(ttk.Treeview):
 
     available_selection = {'current', 'previous'}
 
-    def __init__(self, master:ttk.Frame, files_list:list, entry_dir:str, fileOptions:List[FileOptions], **kw):
+    def __init__(self, master:ttk.Frame, files_list:list, entry_dir:str, fileOptions:List[FileOptions],
+                 conversion_pool:ConversionPool, **kw):
 
         super().__init__(master, selectmode='none', columns=("Files", "Type"), show='', **kw)
 
         self.entry_dir = entry_dir
         self.fileOptions = fileOptions
+        self.status = EntryStatus(entry_dir)
+        self.pending:List[int] = []         # iids of the files still converted by the webserver
+        self.converting:List[int] = []      # iids of the files converted locally by the conversion_pool
+        self.results = queue.Queue()        # (iid, Future) of the local conversions, read on the Tk thread
+        self.conversion_pool = conversion_pool
+        self.futures:list = []
+        self.poll_flag:str = None
+        self.progress = tk.DoubleVar()      # percent of the files ready to be selected
 
         self.heading("Files", text = 'Files', anchor=tk.CENTER, )
         self.heading("Type", text='Type', anchor=tk.CENTER)
         self.column('Files', stretch=tk.YES, anchor='w')
         self.column('Type', stretch=tk.YES, width=50, anchor='center')
+        self.tag_configure('pending', foreground='grey')
                 
         self._populate_list(files_list)
     
@@ -217,6 +228,12 @@ class FileListbox(ttk.Treeview):
             and increases selected files counter.
         """
 
+        # files that are still being converted can not be selected
+        if self.focus() == '' or self.tag_has('pending', self.focus()):
+            if len(self.selection()) > 0:
+                self.focus(self.prev_selection)
+            return
+
         if self.focus() not in self.selection():
             self.selection_add(self.new_selection)
         else:
@@ -228,47 +245,134 @@ class FileListbox(ttk.Treeview):
         self.no_sel_itm.set(len(self.selection()))
 
 
+    def destroy(self) -> None:
+        if self.poll_flag is not None:
+            self.after_cancel(self.poll_flag)
+        for future in self.futures:
+            future.cancel()
+        super().destroy()
+
+
     def _populate_list(self, files_list:list) -> None:
         """ Populates the FileListbox with the files found in folder.
+            Every file gets its row at once. Files already normalized by the webserver
+            are ready, the ones still in flight are polled until they are done and the
+            ones without a status are converted in parallel by the conversion_pool.
+            The item iid is the index of the file in files_list and in self.fileOptions,
+            so the results line up whatever order the conversions finish in.
         """
 
-        # if an exception occurs we keep the iterator consecutive
-        exceptions = 0
-        
+        self.fileOptions.clear()
+        self.fileOptions.extend([None] * len(files_list))
+        status = self.status.read()
+
         for file_i, file in enumerate(files_list):
 
-            try:
-                pdf_obj = PDFConverter(self.entry_dir, file)
+            info = status.get(file)
+
+            if info is None:
+                # not uploaded through the webserver (or uploaded before the status existed)
+                logger.debug(f'Starting conversion for file \'{file}\' ...')
+                future = self.conversion_pool.convert(self.entry_dir, file)
+                future.add_done_callback(lambda future, file_i=file_i: self.results.put((file_i, future)))
+                self.futures.append(future)
+
+                self._insert(file_i, file, pending=True)
+                self.converting.append(file_i)
+
+            elif info['state'] == STATUS_DONE:
+                self._insert(file_i, file)
+                self._set_done(file_i, info)
+
+            elif info['state'] == STATUS_PENDING:
+                self._insert(file_i, file, pending=True)
+                self.pending.append(file_i)
+
+            else:
+                logger.debug(f'Conversion failed for file \'{file}\' -> {info.get("error")}')
+
+        self._update_progress()
+
+        if self.pending or self.converting:
+            self.poll_flag = self.after(CONVERSION_POLL_INTERVAL, self._poll_pending)
+
+
+    def _poll_pending(self) -> None:
+        """ Collects the finished local conversions and checks the EntryStatus
+            for the files still being converted by the webserver.
+        """
+
+        while not self.results.empty():
+            file_i, future = self.results.get()
+            self.converting.remove(file_i)
+
+            if future.cancelled():
+                continue
 
-                if pdf_obj.get_f_ext != 'pdf':
-                    log_str = f'Starting img to pdf conversion for file \'{file}\' ... '
-                    pdf_obj.convert_image_w_pmargin()
+            if future.exception() is None:
+                logger.debug(f'Conversion for file \'{self._file(file_i)}\' ... Done')
+                self._set_done(file_i, future.result())
+            else:
+                self._set_failed(file_i, repr(future.exception()))
 
-                else:
-                    log_str = f'Starting pdf to pdf conversion for file \'{file}\' ... '
-                    pdf_obj.check_and_resize_pdf()
+        status = self.status.read() if self.pending else {}
 
-                log_str += 'Done'
+        for file_i in list(self.pending):
+            info = status.get(self._file(file_i))
 
-            except Exception as e:
-                log_str += repr(e)
-                exceptions += 1
+            if info is None or info['state'] == STATUS_PENDING:
+                continue
 
+            self.pending.remove(file_i)
+
+            if info['state'] == STATUS_DONE:
+                self._set_done(file_i, info)
             else:
-                # Insert the file in the FileListbox
-                self._insert(pdf_obj, file_i-exceptions, file)
+                self._set_failed(file_i, info.get('error'))
+
+        self._update_progress()
 
-                # Create the fileOptions required for this file index
-                self.fileOptions.insert(file_i-exceptions, FileOptions(pdf_obj))                
+        self.poll_flag = (self.after(CONVERSION_POLL_INTERVAL, self._poll_pending)
+                          if self.pending or self.converting else None)
+
+
+    def _update_progress(self) -> None:
+        total = len(self.fileOptions)
+        waiting = len(self.pending) + len(self.converting)
+        self.progress.set(100 * (total - waiting) / total if total else 100)
+
+
+    def _set_done(self, file_i:int, info:dict) -> None:
+        """ Makes the item selectable and creates the fileOptions required for this file index.
+        """
 
-            logger.debug(log_str)
+        name, ext = os.path.splitext(self._file(file_i))
+        self.item(file_i, values=(name, ext[1:].upper()), tags=())
+        self.fileOptions[file_i] = FileOptions(info['orientation'])
 
 
-    def _insert(self, pdf_obj:PDFConverter, file_i:int, file:str) -> str:
+    def _set_failed(self, file_i:int, error:str) -> None:
+        logger.debug(f'Conversion failed for file \'{self._file(file_i)}\' -> {error}')
+        self.delete(file_i)
+
+
+    def _file(self, file_i:int) -> str:
+        """ Returns the uploaded file name of an item (the text without the '.1').
+        """
+
+        return os.path.splitext(self.item(file_i)['text'])[0]
+
+
+    def _insert(self, file_i:int, file:str, pending:bool = False) -> str:
         """ Inserts the PDF document into the FileList. The matching filename must have a .1 at the end.
+            A pending item shows a 'converting…' state and can not be selected.
         """
-    
-        return self.insert('', 'end', values=(pdf_obj.get_f_name, pdf_obj.get_f_ext.upper()), iid=file_i, text=file + '.1')
+
+        name, ext = os.path.splitext(file)
+        values = (name + '  converting…', '…') if pending else (name, ext[1:].upper())
+        tags = ('pending',) if pending else ()
+
+        return self.insert('', 'end', values=values, iid=file_i, text=file + '.1', tags=tags)
        
 
 
@@ -279,13 +383,13 @@ class PageBtn(ttk.Button):
         super().__init__(master, takefocus=0, **kw)
 
 
-    def next_page(self, pdf_obj:PDFConverter) -> None:
+    def next_page(self, pdf_obj:PDFModifier) -> None:
         current_page = pdf_obj.current_page.get()
-        if (current_page < pdf_obj.page_count - 1):
+        if (current_page < pdf_obj.sheet_count - 1):
             pdf_obj.current_page.set(current_page + 1)
 
 
-    def prev_page(self, pdf_obj:PDFConverter) -> None:
+    def prev_page(self, pdf_obj:PDFModifier) -> None:
         current_page = pdf_obj.current_page.get()
         if (current_page > 0):
             pdf_obj.current_page.set(current_page - 1)
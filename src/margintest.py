@@ -0,0 +1,98 @@
+""" Test of the printer margins of the plain A4 PDFs. An A4 PDF with links is converted
+    twice (PDFConverter): passed through, with the contents transformed in place, and
+    rebuilt with show_pdf_page(), the path of the other page sizes. Both must place the
+    contents the same, and the links of the passthrough must stay on their text.
+
+    python3 src/margintest.py
+
+    Exits with 1 if the outputs differ or a link is off its text.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import fitz_old as fitz
+
+LINKS = {'Portrait link': 'https://example.com/portrait', 'Other link': 'https://example.com/other'}
+MAX_PIXEL_DIFF = 2          # mean difference of the rendered pages, of 255
+MAX_LINK_OFFSET = 1         # points between a link and its text
+
+
+
+def generate_pdf(f_path:str) -> None:
+    """ Two A4 pages, portrait and landscape, each with a line of text under a link.
+    """
+
+    doc = fitz.Document()
+
+    for (text, uri), paper in zip(LINKS.items(), ('a4', 'a4-l')):
+        rect = fitz.paper_rect(paper)
+        page = doc.new_page(width = rect.width, height = rect.height)
+        page.draw_rect(fitz.Rect(40, 40, rect.width - 40, rect.height - 40), color=(0, 0, 1), width=2)
+        page.insert_text((100, 200), text, fontsize=24)
+        page.insert_link(dict(kind=fitz.LINK_URI, uri=uri, **{'from': page.search_for(text)[0]}))
+
+    doc.save(f_path)
+    doc.close()
+
+
+def convert(entry_dir:str, file:str, rebuild:bool) -> fitz.Document:
+
+    from pdftools import PDFConverter
+
+    pdf_obj = PDFConverter(entry_dir, file)
+    if rebuild is True:
+        pdf_obj._is_plain_a4 = lambda page: False
+
+    try:
+        pdf_obj.check_and_resize_pdf()
+    finally:
+        pdf_obj.close()
+
+    f_path = os.path.join(entry_dir, file + '.1')
+    converted = os.path.join(entry_dir, ('rebuilt-' if rebuild else 'passthrough-') + file)
+    os.replace(f_path, converted)
+
+    return fitz.Document(converted)
+
+
+def main() -> int:
+
+    entry_dir = tempfile.mkdtemp(prefix='margintest-')
+    generate_pdf(os.path.join(entry_dir, 'linked.pdf'))
+    failed = False
+
+    try:
+        passthrough = convert(entry_dir, 'linked.pdf', rebuild=False)
+        rebuilt = convert(entry_dir, 'linked.pdf', rebuild=True)
+
+        for page, other, (text, uri) in zip(passthrough, rebuilt, LINKS.items()):
+            if page.rect != other.rect:
+                print(f'page {page.number}: size {page.rect} != {other.rect}')
+                failed = True
+                continue
+
+            pix, other_pix = page.get_pixmap(alpha=False), other.get_pixmap(alpha=False)
+            diff = sum(abs(a - b) for a, b in zip(pix.samples, other_pix.samples)) / len(pix.samples)
+
+            # the text is found where the rebuild drew it
+            text_rect = other.search_for(text)[0]
+            links = [link for link in page.get_links() if link.get('uri') == uri]
+            offset = max(abs(a - b) for a, b in zip(links[0]['from'], text_rect)) if links else None
+
+            print(f'page {page.number}: pixel diff {diff:.2f}, link {links[0]["from"] if links else None}, '
+                  f'text {text_rect}')
+            failed |= diff > MAX_PIXEL_DIFF or offset is None or offset > MAX_LINK_OFFSET
+
+        passthrough.close()
+        rebuilt.close()
+
+    finally:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
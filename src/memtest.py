@@ -0,0 +1,125 @@
+""" Memory test of LOW_MEMORY_MODE. A Letter PDF of N pages with a photo on every page
+    is generated, normalized to A4 (PDFConverter) and printed duplex with a page layout
+    (render_job), under a memory ceiling. The peak resident memory of each stage is
+    reported and checked against the ceiling.
+
+    python3 src/memtest.py --pages 500 --ceiling 160 --layout 2 --raster
+
+    Exits with 1 if a stage fails or goes over the ceiling.
+"""
+
+import argparse
+import io
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+import typing
+import fitz_old as fitz
+from PIL import Image
+
+
+
+def generate_pdf(f_path:str, pages:int) -> None:
+    """ Letter pages, so that they are resized to A4, each with its own photo-like image.
+    """
+
+    doc = fitz.Document()
+    rect = fitz.paper_rect('letter')
+
+    for page_no in range(pages):
+        page = doc.new_page(width = rect.width, height = rect.height)
+        img = Image.frombytes('RGB', (200, 150), os.urandom(200 * 150 * 3))
+        stream = io.BytesIO()
+        img.save(stream, format='JPEG', quality=90)
+        page.insert_image(fitz.Rect(72, 72, rect.width - 72, rect.height / 2), stream=stream.getvalue())
+        page.insert_text((72, rect.height / 2 + 40), f'Page {page_no + 1}', fontsize=24)
+
+    doc.save(f_path, deflate=True)
+    doc.close()
+
+
+def peak_rss(fn:typing.Callable, *args) -> typing.Tuple[int, float]:
+    """ Runs fn, returns the peak resident memory in bytes sampled while it ran and the seconds it took.
+    """
+
+    from pdftools import process_rss
+
+    peak = process_rss()
+    done = threading.Event()
+
+    def sample() -> None:
+        nonlocal peak
+        while not done.wait(0.01):
+            peak = max(peak, process_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+
+    try:
+        fn(*args)
+    finally:
+        done.set()
+        sampler.join()
+
+    return max(peak, process_rss()), time.perf_counter() - start
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='LOW_MEMORY_MODE test')
+    parser.add_argument('--pages', type=int, default=500, help='pages of the generated PDF')
+    parser.add_argument('--ceiling', type=int, default=160, help='MEMORY_CEILING in MB')
+    parser.add_argument('--layout', type=int, default=2, choices=[1, 2, 4], help='pages per sheet')
+    parser.add_argument('--raster', action='store_true', help='print in grayscale with PRINT_GRAYSCALE_RASTER')
+    args = parser.parse_args()
+
+    # read by pdftools when it is imported
+    import constants
+    constants.LOW_MEMORY_MODE = True
+    constants.MEMORY_CEILING = args.ceiling * 1024 * 1024
+    constants.PRINT_GRAYSCALE_RASTER = args.raster
+
+    from spooler import render_job
+    from pdftools import PDFConverter
+
+    entry_dir = tempfile.mkdtemp(prefix='memtest-')
+    generate_pdf(os.path.join(entry_dir, 'memtest.pdf'), args.pages)
+    failed = False
+
+    # the conversion is not taken from the ConversionCache, the generated PDF is new anyway
+    def conversion() -> None:
+        pdf_obj = PDFConverter(entry_dir, 'memtest.pdf')
+        try:
+            pdf_obj.check_and_resize_pdf()
+        finally:
+            pdf_obj.close()
+
+    def print_job() -> None:
+        render_job(entry_dir, [('memtest.pdf.1', args.layout, None)], args.raster, True, 1,
+                   os.path.join(entry_dir, 'job.pdf'))
+
+    try:
+        for name, stage in (('conversion', conversion), ('print job', print_job)):
+            try:
+                peak, seconds = peak_rss(stage)
+            except MemoryError as e:
+                print(f'{name}: failed, {e}')
+                failed = True
+                break
+
+            over = peak > constants.MEMORY_CEILING
+            failed |= over
+            print(f'{name}: peak {peak / 2**20:.0f} MB, ceiling {args.ceiling} MB, {seconds:.1f} s'
+                  + (' -> OVER' if over else ''))
+
+    finally:
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
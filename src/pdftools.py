@@ -1,10 +1,104 @@
 import fitz_old as fitz
-from PIL import Image
+from PIL import Image, ImageOps
+import io
 import os
-from logger import logger
 import typing
+import threading
 import tkinter as tk
-from tkinter import ttk
+from constants import *
+
+
+if LOW_MEMORY_MODE is True:
+    fitz.TOOLS.set_low_memory(True)         # no caching of the display lists
+
+
+
+def process_rss() -> int:
+    """ Resident memory of the process in bytes, 0 where /proc is not available.
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def limit_memory(release:typing.Callable[[], None] = None) -> None:
+    """ Called between pages in LOW_MEMORY_MODE. Over 3/4 of MEMORY_CEILING the MuPDF store
+        (fonts, images and objects kept from the pages already done) is emptied and release
+        is called to drop whatever else the caller can. A MemoryError is raised when it is
+        still over the ceiling, so the job fails before the process is killed by the OOM
+        killer.
+    """
+
+    if LOW_MEMORY_MODE is not True or process_rss() < MEMORY_CEILING * 3 // 4:
+        return
+
+    fitz.TOOLS.store_shrink(100)
+    if release is not None:
+        release()
+    rss = process_rss()
+
+    if rss > MEMORY_CEILING:
+        raise MemoryError(f'{rss} bytes resident, over the ceiling of {MEMORY_CEILING} bytes')
+
+
+
+class PrintWriter:
+    """ The output doc of a print job, written to f_path. The pages added so far can be
+        flushed to disk, the doc is then reopened from the file and only the following
+        pages are held in memory until the next flush.
+    """
+
+    FLUSH_PAGES = 8                         # fewer new pages are not worth the save and reopen
+
+
+    def __init__(self, f_path:str):
+        self.f_path:str = f_path
+        self.doc:fitz.Document = fitz.Document()
+        self.flushed:bool = False           # f_path exists, the next saves are incremental
+        self.flushed_pages:int = 0          # pages already on disk
+
+
+    @property
+    def page_count(self) -> int:
+        return self.doc.page_count
+
+
+    def flush(self) -> None:
+
+        if self.page_count - self.flushed_pages < PrintWriter.FLUSH_PAGES:
+            return
+
+        if self.flushed is True:
+            self.doc.saveIncr()
+        else:
+            self.doc.save(self.f_path, deflate=True)
+            self.flushed = True
+
+        self.doc.close()
+        self.doc = fitz.open(self.f_path)
+        self.flushed_pages = self.page_count
+
+
+    def close(self) -> None:
+
+        if self.flushed is True:
+            self.doc.saveIncr()
+        else:
+            self.doc.save(self.f_path, garbage=3, deflate=True)
+        self.doc.close()
+
+
+
+def file_version(f_path:str) -> tuple:
+    """ Identifies the content of a file on disk without reading it.
+    """
+
+    stat = os.stat(f_path)
+    return (f_path, stat.st_mtime_ns, stat.st_size)
+
 
 
 class PDFConverter(fitz.Document):
@@ -14,11 +108,14 @@ class PDFConverter(fitz.Document):
         self.entry_dir:str = entry_dir                                  # path to /tmp/.. dir
         self.file:str = file                                            # file name with extension
         self.f_path:str = os.path.join(self.entry_dir, self.file)       # complete path to file
-        self.current_page = tk.IntVar()
-        self.current_page.set(0)
-        self.output_pdf_f_path:str = ''                                 # the modified pdf path (saveIncr() can only save once)
+        self.output_pdf_f_path:str = ''                                 # the normalized file ('.1') written by the conversion
+        self.lock = threading.RLock()                                   # held while the doc is rendered or modified
 
-        super().__init__(self.f_path)
+        # images are read with PIL a frame at a time, MuPDF would decode every TIFF frame on open
+        if self.get_f_ext in FILE_TYPES and self.get_f_ext != 'pdf':
+            super().__init__()
+        else:
+            super().__init__(self.f_path)
 
     
     @property
@@ -39,33 +136,92 @@ class PDFConverter(fitz.Document):
 
 
     def convert_image_w_pmargin(self):
-        """ Converts image file to A4 PDF doc. Printer margins are added.
+        """ Converts image file to A4 PDF doc, with a page for every frame of a multi-page
+            TIFF. The frames are read one at a time. Printer margins are added.
         """
 
         out = fitz.Document()       # opens the out PDF doc
 
         img = Image.open(self.f_path)                                       # using PIL for because its faster than Pixmap
-        img_orientation, img_ratio = self._get_img_orientation(img)         # returns image orientation
+        frames = getattr(img, 'n_frames', 1)
+
+        for frame in range(frames):
+            img.seek(frame)
+            img_orientation, img_ratio = self._get_img_orientation(img)     # returns image orientation
         
-        page_rect:fitz.Rect = fitz.paper_rect('a4-' + img_orientation)      # set papper size for the PDF in which the image will be inserted to
-        page:fitz.Document = out.new_page(width = page_rect.width, height = page_rect.height)       # insert a new blank page in the PDF
+            page_rect:fitz.Rect = fitz.paper_rect('a4-' + img_orientation)  # set papper size for the PDF in which the image will be inserted to
+            page:fitz.Document = out.new_page(width = page_rect.width, height = page_rect.height)       # insert a new blank page in the PDF
 
-        if img_ratio == 1:
-            img_rect = fitz.Rect(0, 0, page_rect.width, page_rect.width)
-        else:
-            img_rect = fitz.Rect(0, 0, page_rect.width, page_rect.height)
+            if img_ratio == 1:
+                img_rect = fitz.Rect(0, 0, page_rect.width, page_rect.width)
+            else:
+                img_rect = fitz.Rect(0, 0, page_rect.width, page_rect.height)
 
-        img_rect = self._add_printer_margins(img_rect)
+            img_rect = self._add_printer_margins(img_rect)
 
-        page.insert_image(filename=self.f_path, rect=img_rect, keep_proportion = True, alpha=0)  # insert the image into the 'out' pdf doc
+            # the file holds more than the frame, it can't be inserted as is
+            stream = self._print_image(img, img_rect, as_is=frames == 1)
+            if stream is None:
+                page.insert_image(filename=self.f_path, rect=img_rect, keep_proportion = True, alpha=0)  # insert the image into the 'out' pdf doc
+            else:
+                page.insert_image(stream=stream, rect=img_rect, keep_proportion = True, alpha=0)
+            limit_memory()
 
-        self._save_and_close(out)
+        img.close()
+        self._save_and_close(out, deflate=True)        # PNG, BMP and TIFF pixels are inserted uncompressed
+
+
+    def _print_image(self, img:Image.Image, rect:fitz.Rect, as_is:bool = True) -> typing.Optional[bytes]:
+        """ Resamples an image larger than needed to print it in rect at IMAGE_PRINT_DPI and
+            applies its EXIF orientation. JPEG photos are encoded again at IMAGE_JPEG_QUALITY,
+            the other images losslessly. Returns None if the original file can be used as is.
+        """
+
+        width, height = self._img_size(img)
+        scale = min(rect.width / width, rect.height / height) * IMAGE_PRINT_DPI / 72
+        is_jpeg = img.format == 'JPEG'
+
+        if as_is is True and scale >= 1 and self._exif_orientation(img) == 1:
+            return None
+
+        if scale < 1 and is_jpeg:
+            # decoded directly at the nearest 1/2, 1/4 or 1/8 of its size
+            img.draft(None, (img.width * scale, img.height * scale))
+
+        if self._exif_orientation(img) != 1:
+            img = ImageOps.exif_transpose(img)
+
+        # scans come as bilevel or 16 bit frames, PNG has no CMYK
+        if img.mode.startswith('I'):
+            img = img.convert('I').point(lambda v: v * (1 / 256)).convert('L')
+        elif img.mode == '1':
+            img = img.convert('L')
+        elif img.mode not in ('L', 'RGB', 'RGBA', 'CMYK' if is_jpeg else 'RGB'):
+            img = img.convert('RGBA' if img.has_transparency_data else 'RGB')
+
+        if scale < 1:
+            # a box reduce by an integer factor comes first, so a large scan is not resampled in full
+            img = img.resize((round(width * scale), round(height * scale)), Image.LANCZOS, reducing_gap=2.0)
+
+        buffer = io.BytesIO()
+        if is_jpeg:
+            img.save(buffer, 'JPEG', quality=IMAGE_JPEG_QUALITY)
+        else:
+            img.save(buffer, 'PNG')
+
+        return buffer.getvalue()
 
 
     def check_and_resize_pdf(self):
         """ Checks if a document of A4 paper size if not it transforms the pages to this format.
+            A doc with only plain A4 pages is passed through, the margins are added with a
+            transform of the page contents instead of rebuilding every page.
         """
-        
+
+        if all(self._is_plain_a4(page) for page in self):
+            self._add_margins_in_place()
+            return
+
         out = fitz.Document()
 
         for page in self:
@@ -88,10 +244,55 @@ class PDFConverter(fitz.Document):
             rect = self._add_printer_margins(resized_page.rect)
             
             resized_page.show_pdf_page(rect, self, page.number)
+            limit_memory()
 
         self._save_and_close(out)
 
 
+    def _is_plain_a4(self, page:fitz.Page) -> bool:
+        """ A4 in either orientation (within a point), not rotated or cropped and without
+            annotations that a transform of the contents would leave in place.
+        """
+
+        size = sorted((page.mediabox.width, page.mediabox.height))
+        return (abs(size[0] - 595) < 1 and abs(size[1] - 842) < 1
+                and page.rotation == 0 and page.cropbox == page.mediabox
+                and page.first_annot is None and page.first_widget is None)
+
+
+    def _add_margins_in_place(self) -> None:
+        """ Shrinks the contents of every page around its center to fit the printer margins,
+            the same placement show_pdf_page() gives, and saves the doc as the '.1' file.
+            The links are moved with the contents, show_pdf_page() would drop them.
+        """
+
+        for page in self:
+            box = page.mediabox
+            zoom = min((box.width - 20) / box.width, (box.height - 20) / box.height)
+            dx = (box.x0 + box.x1) / 2 * (1 - zoom)
+            dy = (box.y0 + box.y1) / 2 * (1 - zoom)
+
+            # the contents are wrapped in q/Q and preceded by a stream with the transform
+            page.wrap_contents()
+            xref = self.get_new_xref()
+            self.update_object(xref, '<<>>')
+            self.update_stream(xref, f'{zoom:g} 0 0 {zoom:g} {dx:g} {dy:g} cm\n'.encode())
+            self.xref_set_key(page.xref, 'Contents',
+                              '[' + ' '.join(f'{x} 0 R' for x in [xref] + page.get_contents()) + ']')
+
+            # the links are in page coordinates, with the origin at the top left
+            center = page.rect.tl + (page.rect.br - page.rect.tl) * 0.5
+            matrix = fitz.Matrix(zoom, 0, 0, zoom, center.x * (1 - zoom), center.y * (1 - zoom))
+            for link in page.get_links():
+                link['from'] = link['from'] * matrix
+                page.update_link(link)
+
+            limit_memory()
+
+        self.output_pdf_f_path = self._output_f_path()
+        self.save(self.output_pdf_f_path, garbage=1, deflate=True)
+
+
     def get_orientation(self) -> str:
         """ Returns a string of the orientation of the fitz.Document.
         """          
@@ -100,140 +301,236 @@ class PDFConverter(fitz.Document):
         return 'P' if width <= height else 'L'
         
 
-    def create_img_from_pdf(self) -> Image.Image:
-        """ Converts a page from a PDF doc to PIL.Image
+    def create_img_from_pdf(self, page_no:int = 0, size:typing.Tuple[int, int] = None,
+                            grayscale:bool = False) -> Image.Image:
+        """ Converts a page from a PDF doc to PIL.Image.
+            If a size (width, height) is given the page is rasterized directly at the
+            scale that fits it, instead of 72 dpi followed by a resize.
+            Grayscale pages are rendered in a gray colorspace.
         """
 
-        # fitz.TOOLS.store_shrink(10)                           # see https://github.com/pymupdf/PyMuPDF/issues/2588
-        
-        first_page:fitz.Page = self.load_page(self.current_page.get())
-        pix:fitz.Pixmap = first_page.get_pixmap()
+        with self.lock:
+            return self._render_page(self.load_page(page_no), size, grayscale)
 
-        return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
 
+    def _render_page(self, page:fitz.Page, size:typing.Tuple[int, int], grayscale:bool) -> Image.Image:
 
-    def _save_and_close(self, doc:fitz.Document) -> None:
-        
-        ext = self._increase_extension()
+        # fitz.TOOLS.store_shrink(10)                           # see https://github.com/pymupdf/PyMuPDF/issues/2588
 
-        path = os.path.join(self.entry_dir, self.get_f_name)
-        self.output_pdf_f_path = path + ext
+        matrix = fitz.Identity
+        if size is not None:
+            zoom = min(size[0] / page.rect.width, size[1] / page.rect.height)
+            matrix = fitz.Matrix(zoom, zoom)
 
-        doc.save(self.output_pdf_f_path)
-        doc.close()
+        colorspace = fitz.csGRAY if grayscale is True else fitz.csRGB
+        pix:fitz.Pixmap = page.get_pixmap(matrix=matrix, colorspace=colorspace, alpha=False)
 
-    
-    def _increase_extension(self) -> str:
-        """ Increases the current extension of the document.
-        """
+        return Image.frombytes('L' if grayscale is True else 'RGB', [pix.width, pix.height], pix.samples)
 
-        current_ext:str = self.get_f_ext
 
-        try:
-            numeric_ext:int = int(current_ext.split('.')[-1])
-            numeric_ext += 1
-            return ('.' + str(numeric_ext))
-        
-        except ValueError:
-            return ('.' + self.get_f_ext + '.1')
+    def _save_and_close(self, doc:fitz.Document, deflate:bool = False) -> None:
         
-        except Exception as e:
-            logger.debug(repr(e))
+        self.output_pdf_f_path = self._output_f_path()
+
+        doc.save(self.output_pdf_f_path, deflate=deflate)
+        doc.close()
+
+
+    def _output_f_path(self) -> str:
+        """ The upload is converted once, to the upload name + '.1'.
+        """
+        return self.f_path + '.1'
 
 
     def _get_img_orientation(self, img:Image.Image) -> typing.Tuple[str, float]:
-        orientation = 'P' if img.width <= img.height else 'L'
-        ratio = max(img.width, img.height) / min(img.width, img.height)
+        width, height = self._img_size(img)
+        orientation = 'P' if width <= height else 'L'
+        ratio = max(width, height) / min(width, height)
         return orientation, ratio
 
 
+    def _img_size(self, img:Image.Image) -> typing.Tuple[int, int]:
+        """ Size of the image as displayed, with its EXIF orientation applied.
+        """
+
+        if self._exif_orientation(img) in (5, 6, 7, 8):        # rotated by 90 or 270 degrees
+            return img.height, img.width
+        return img.size
+
+
+    def _exif_orientation(self, img:Image.Image) -> int:
+        return img.getexif().get(0x0112, 1)
+
+
     def _add_printer_margins(self, rect:fitz.Rect) -> fitz.Rect:
         return rect + (10, 10, -10, -10) 
 
 
 
-class PDFModifier(PDFConverter):
-    
-    def __init__(self, entry_dir: str, file: str, file_list:ttk.Treeview):
-    
-        super().__init__(entry_dir, file)
-        self.file_list = file_list
-        self.orientation:str = self.get_orientation()
-        self.counter = 1
-        self.transfer_pdf:fitz.Document = None
+class PDFLayout(PDFConverter):
+    """ The normalized doc (the '.1' file) opened once, with a page layout (pages per sheet)
+        and an orientation applied on top of it. The sheets are built lazily, only the
+        ones that are rendered, and the full doc only when it is saved or printed.
+    """
+
+    def __init__(self, entry_dir:str, file:str, layout:int = 1, orientation:str = None):
+        # the edits always apply to the '.1' file, nothing is saved
+        # the upload or its '.1' file may be given, the edits always apply to the '.1' file
+        super().__init__(entry_dir, os.path.splitext(file)[0] + '.1')
+        self.f_version:tuple = file_version(self.f_path)
+
+        self.layout:int = 1                 # pages per sheet: 1, 2 or 4
+        self.orientation:str = None         # 'P' or 'L' the sheets are rotated to, None if each keeps its own
+        self.multiple_pages(layout)
+
+        if orientation is not None:
+            self.rotate_pages(orientation)
 
 
     @property
-    def output_pdf_name(self):
-        return os.path.basename(self.output_pdf_f_path)
+    def version(self) -> tuple:
+        """ Identifies the content of the sheets: the source file and the edits applied to it.
+        """
+        return self.f_version + (self.layout, self.sheet_orientation())
+
+
+    @property
+    def sheet_count(self) -> int:
+        if self.page_count == 1:
+            return 1                        # a single page is repeated on the sheet
+        return -(-self.page_count // self.layout)
 
 
-    def __del__(self, increase_extension = False):
-        """ When the doc in memeory is destroyed save it locally and update the
-            new name in the Filelistbox object.
+    def rotate_pages(self, rot:str) -> None:
+        """ Sets the orientation of the sheets. Sheets of the other orientation
+            are scaled to fit the rotated paper. The natural orientation of the layout
+            (the one of the first sheet) leaves every sheet as it is, so the pages of a
+            doc with mixed orientations are only rotated when the user asks for it.
         """
 
-        if self.transfer_pdf is not None and increase_extension is True:
+        with self.lock:
+            self.orientation = None if rot == self._natural_orientation() else rot
 
-            self._save_and_close(self)
-            self.transfer_pdf = None
 
-            for child in self.file_list.get_children():
-                item = self.file_list.item(child)
+    def multiple_pages(self, pp_sheet:int) -> None:
+        """ Sets the number of pages combined on each sheet. The orientation is reset
+            to the natural orientation of the new layout.
+        """
 
-                if self.file in item['text']:
-                    self.file_list.item(child, text=self.output_pdf_name)
-                    break
-                
-        return super().__del__()
+        with self.lock:
+            self.layout = pp_sheet
+            self.orientation = None
 
 
-    def rotate_pages(self, rot:str) -> None:
-        """ Roates the pages and page content of the doc.
+    def sheet_orientation(self) -> str:
+        return self.orientation or self._natural_orientation()
+
+
+    def create_img_from_pdf(self, page_no:int = 0, size:typing.Tuple[int, int] = None,
+                            grayscale:bool = False) -> Image.Image:
+        """ Converts a sheet to PIL.Image, see PDFConverter.create_img_from_pdf().
+        """
+
+        with self.lock:
+            sheet = fitz.Document()
+            try:
+                self._add_sheet(sheet, page_no)
+                return self._render_page(sheet.load_page(0), size, grayscale)
+            finally:
+                sheet.close()
+
+
+    def add_print_sheets(self, out:PrintWriter, grayscale:bool = False, sheets_multiple:int = 1) -> int:
+        """ The output stage: appends the print-ready sheets to out, one sheet at a time.
+            Grayscale is left to the printer (print-color-mode=monochrome) and the sheets
+            keep their vector content. With PRINT_GRAYSCALE_RASTER, for printers without
+            monochrome support, grayscale sheets are rasterized in a gray colorspace at
+            PRINT_GRAYSCALE_DPI and only the compressed image is kept. In LOW_MEMORY_MODE the sheets are flushed to
+            disk whenever the memory runs high. Blank sheets are added to reach a multiple
+            of sheets_multiple, so whatever follows in a duplex job starts on a new sheet.
+            Returns the number of sheets added.
         """
 
-        ## Save original doc
-        if self.counter == 1:
-            self.first_pdf = self.tobytes()
-            self.counter += 1
+        start = out.page_count
+        zoom = PRINT_GRAYSCALE_DPI / 72
+
+        with self.lock:
+            for sheet_no in range(self.sheet_count):
+                if grayscale is True and PRINT_GRAYSCALE_RASTER is True:
+                    paper, _ = self.placements(sheet_no)
+                    sheet = fitz.Document()
+                    try:
+                        pix = self._add_sheet(sheet, sheet_no).get_pixmap(matrix=fitz.Matrix(zoom, zoom),
+                                                                          colorspace=fitz.csGRAY, alpha=False)
+                    finally:
+                        sheet.close()
+                    xref = out.doc.new_page(width = paper.width, height = paper.height).insert_image(paper, pixmap=pix)
+                    # the doc would hold the raw samples until it is saved, they are compressed right away
+                    out.doc.update_stream(xref, pix.samples, compress=True)
+                    pix = None
+                else:
+                    self._add_sheet(out.doc, sheet_no)
+                limit_memory(release=out.flush)
+
+            while (out.page_count - start) % sheets_multiple:
+                paper = out.doc[-1].rect
+                out.doc.new_page(width = paper.width, height = paper.height)
+
+        return out.page_count - start
+
 
+    def placements(self, sheet_no:int) -> typing.Tuple[fitz.Rect, typing.List[typing.Tuple[int, fitz.Rect]]]:
+        """ The edit model: returns the paper rect of a sheet and the (source page no, rect)
+            of every page placed on it. The layout and the orientation are composed into
+            these rects so every source page is placed once, without intermediate docs.
+        """
+
+        w, h, r_tab = self._layout_rects()
 
-        if rot != self.orientation:
-            self.transfer_pdf = fitz.Document(stream=self.tobytes())
-            rect = fitz.paper_rect("a4-" + rot)
+        if not r_tab:
+            paper = self[sheet_no].rect
+            pages = [(sheet_no, paper)]
 
         else:
-            rect = fitz.paper_rect("a4-" + self.orientation)
-            self.transfer_pdf = fitz.Document(stream=self.first_pdf)
+            paper = fitz.Rect(0, 0, w, h)
+            # a single page doc gets the same page in every rect
+            pages = [(0 if self.page_count == 1 else sheet_no * self.layout + tab, r_tab[tab])
+                     for tab in range(len(r_tab))]
+            pages = [(page_no, rect) for page_no, rect in pages if page_no < self.page_count]
 
-        self.delete_pages(0, self.page_count-1)
+        sheet_orientation = 'P' if paper.width <= paper.height else 'L'
 
-        for page in self.transfer_pdf:
-            newpage = self.new_page(width = rect.width, height = rect.height)
-            newpage.show_pdf_page(rect, self.transfer_pdf, page.number, keep_proportion = True)
+        if self.orientation is not None and sheet_orientation != self.orientation:
+            # the sheet is scaled to fit the rotated paper and centered on it
+            rotated = fitz.paper_rect("a4-" + self.orientation)
+            zoom = min(rotated.width / paper.width, rotated.height / paper.height)
+            dx = (rotated.width - paper.width * zoom) / 2
+            dy = (rotated.height - paper.height * zoom) / 2
+            matrix = fitz.Matrix(zoom, 0, 0, zoom, dx, dy)
 
-        self.tobytes(garbage=4)
+            paper = rotated
+            pages = [(page_no, rect * matrix) for page_no, rect in pages]
 
+        return paper, pages
 
-    def multiple_pages(self, pp_sheet:int) -> None:
-        """ Combines multiple pages pdf pages into one. 
-        """
 
-        # Load original pdf
-        self.transfer_pdf = fitz.Document(os.path.join(self.entry_dir, self.get_f_name + '.1'))
-        self.delete_pages(0, self.page_count-1)
+    def _natural_orientation(self) -> str:
+        w, h, _ = self._layout_rects()
+        return 'P' if w <= h else 'L'
 
-        w = self.transfer_pdf[0].rect.br[0]
-        h = self.transfer_pdf[0].rect.br[1]
 
-        if pp_sheet == 1:
+    def _layout_rects(self) -> typing.Tuple[float, float, typing.List[fitz.Rect]]:
+        """ Returns the sheet width, height and the rects in which the pages are placed.
+            An empty list means that the page keeps its own size (1 page per sheet).
+        """
 
-            for page in self.transfer_pdf:
-                newpage = self.new_page(width = page.rect.width, height = page.rect.height)
-                newpage.show_pdf_page(page.rect, self.transfer_pdf, page.number)
-            return
-        
-        elif pp_sheet == 2:
+        w = self[0].rect.br[0]
+        h = self[0].rect.br[1]
+
+        if self.layout == 1:
+            return w, h, []
+
+        elif self.layout == 2:
             w, h = h, w
 
             if w < h:
@@ -243,30 +540,59 @@ class PDFModifier(PDFConverter):
                 r1 = fitz.Rect(0, 0, w/2, h) # left rect
                 r2 = fitz.Rect(w/2, 0, w, h) # right rect
 
-            r_tab = [r1, r2]
+            return w, h, [r1, r2]
 
-        else: ## pp_sheet == 4
-            r1 = self.transfer_pdf[0].rect * 0.5  # top left rect
+        else: ## layout == 4
+            r1 = self[0].rect * 0.5  # top left rect
             r2 = r1 + (r1.width, 0, r1.width, 0)  # top right
             r3 = r1 + (0, r1.height, 0, r1.height)  # bottom left
-            r4 = fitz.Rect(r1.br, self.transfer_pdf[0].rect.br)  # bottom right
+            r4 = fitz.Rect(r1.br, self[0].rect.br)  # bottom right
 
-            r_tab = [r1, r2, r3, r4]
+            return w, h, [r1, r2, r3, r4]
 
-        if self.transfer_pdf.page_count == 1:
 
-            newpage = self.new_page(width = w, height = h)
+    def _add_sheet(self, doc:fitz.Document, sheet_no:int) -> fitz.Page:
+        """ Appends a sheet to doc, placing the source pages directly on it.
+        """
+
+        paper, pages = self.placements(sheet_no)
+        newpage = doc.new_page(width = paper.width, height = paper.height)
+
+        for page_no, rect in pages:
+            newpage.show_pdf_page(rect, self, page_no)
+
+        return newpage
 
-            # insert same page twice            
-            for tab in range(len(r_tab)):
-                newpage.show_pdf_page(r_tab[tab], self.transfer_pdf, newpage.number)
 
-        else:
-            for page in self.transfer_pdf:
-                if page.number % pp_sheet == 0:
-                    newpage = self.new_page(width = w, height =h)
-                newpage.show_pdf_page(r_tab[page.number % pp_sheet], self.transfer_pdf, page.number)
 
-        self.tobytes(garbage=4)
+class PDFModifier(PDFLayout):
+    """ PDFLayout of a file previewed in the kiosk, opened and released by the DocumentSessions.
+    """
+    
+    def __init__(self, entry_dir: str, file: str, layout:int = 1, orientation:str = None):
+    
+        super().__init__(entry_dir, file, layout, orientation)
+        self.current_page = tk.IntVar()
+        self.current_page.set(0)
+
+
+    def release(self) -> None:
+        """ Closes the doc and frees what MuPDF still caches of its pages.
+        """
+
+        with self.lock:
+            if not self.is_closed:
+                self.close()
+
+        fitz.TOOLS.store_shrink(100)
+
+
+    def create_img_from_pdf(self, page_no:int = None, size:typing.Tuple[int, int] = None,
+                            grayscale:bool = False) -> Image.Image:
+        """ Converts a sheet to PIL.Image, by default the current one.
+        """
 
+        if page_no is None:
+            page_no = self.current_page.get()
 
+        return super().create_img_from_pdf(page_no, size, grayscale)
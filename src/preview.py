@@ -0,0 +1,196 @@
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+from collections import OrderedDict
+import os
+import threading
+import queue
+import typing
+from logger import logger
+from pdftools import PDFLayout, PDFModifier
+from constants import *
+
+
+THUMBNAIL_SUFFIX = '.thumb'         # PNG sidecar of a '.1' file, its first sheet as first previewed by the kiosk
+
+
+
+def render_preview(pdf_obj:PDFModifier, page_no:int, grayscale:bool,
+                   version:tuple = None) -> typing.Optional[Image.Image]:
+    """ Renders a page of the doc as an image that fits the preview tk.Canvas.
+        If a version is given, returns None when the doc has been edited since.
+    """
+
+    with pdf_obj.lock:
+        if version is not None and (pdf_obj.is_closed or pdf_obj.version != version):
+            return None
+
+        return pdf_obj.create_img_from_pdf(page_no, size=(C_WIDTH, C_HEIGHT), grayscale=grayscale)
+
+
+def render_file_preview(entry_dir:str, file:str, layout:int, orientation:str, grayscale:bool) -> Image.Image:
+    """ Renders the first sheet of a file that is not opened in the kiosk.
+    """
+
+    pdf_obj = PDFLayout(entry_dir, file, layout, orientation)
+
+    try:
+        return pdf_obj.create_img_from_pdf(0, size=(C_WIDTH, C_HEIGHT), grayscale=grayscale)
+    finally:
+        pdf_obj.close()
+
+
+def save_thumbnail(entry_dir:str, file:str, page_count:int, orientation:str) -> str:
+    """ Writes the first sheet of a '.1' file with the default FileOptions to a PNG sidecar,
+        with the page count and orientation of the doc and the version of the '.1' file it
+        shows in its text chunks. Returns the name of the sidecar.
+    """
+
+    img = render_file_preview(entry_dir, file, 1, orientation, grayscale=False)
+    stat = os.stat(os.path.join(entry_dir, file))
+
+    info = PngInfo()
+    info.add_text('page_count', str(page_count))
+    info.add_text('orientation', orientation)
+    info.add_text('version', f'{stat.st_mtime_ns}:{stat.st_size}')
+
+    f_path = os.path.join(entry_dir, file + THUMBNAIL_SUFFIX)
+    img.save(f_path + '.tmp', format='PNG', pnginfo=info)
+    os.replace(f_path + '.tmp', f_path)
+
+    return os.path.basename(f_path)
+
+
+def load_thumbnail(entry_dir:str, file:str) -> typing.Optional[typing.Tuple[Image.Image, int, str]]:
+    """ Returns the image, page count and orientation of the sidecar of a '.1' file,
+        or None if there is none or the '.1' file changed since it was written.
+    """
+
+    f_path = os.path.join(entry_dir, file)
+
+    try:
+        with Image.open(f_path + THUMBNAIL_SUFFIX) as img:
+            img.load()
+        stat = os.stat(f_path)
+
+        if img.text['version'] != f'{stat.st_mtime_ns}:{stat.st_size}':
+            return None
+
+        return img, int(img.text['page_count']), img.text['orientation']
+
+    except (OSError, KeyError, ValueError) as e:
+        logger.debug(f'No thumbnail for \'{file}\' -> {repr(e)}')
+        return None
+
+
+
+class PreviewCache:
+    """ LRU cache of the rendered preview pages with a byte budget.
+        Keys are (doc version, page no, layout, orientation, color).
+    """
+
+    def __init__(self, max_bytes:int = PREVIEW_CACHE_BYTES):
+        self.max_bytes:int = max_bytes
+        self.size:int = 0                   # bytes held by the cached images
+        self.hits:int = 0
+        self.misses:int = 0
+        self._images:OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key:tuple) -> typing.Optional[Image.Image]:
+        with self._lock:
+            img = self._images.get(key)
+
+            if img is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._images.move_to_end(key)
+
+            return img
+
+
+    def put(self, key:tuple, img:Image.Image) -> None:
+        """ Adds an image and evicts the least recently used ones until the cache fits its budget.
+        """
+
+        img_size = self._img_size(img)
+        if img_size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._images:
+                self.size -= self._img_size(self._images.pop(key))
+
+            self._images[key] = img
+            self.size += img_size
+
+            while self.size > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.size -= self._img_size(evicted)
+
+
+    def clear(self) -> None:
+        with self._lock:
+            logger.debug(f'Preview cache: {self.hits} hits, {self.misses} misses, {self.size} bytes released')
+            self._images.clear()
+            self.size = 0
+
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+
+    def __contains__(self, key:tuple) -> bool:
+        return key in self._images
+
+
+    def _img_size(self, img:Image.Image) -> int:
+        return img.width * img.height * len(img.getbands())
+
+
+
+class Prefetcher:
+    """ Renders the pages the user is likely to look at next into the PreviewCache
+        on a background thread. Scheduling new work cancels the work not yet done.
+    """
+
+    def __init__(self, cache:PreviewCache):
+        self.cache = cache
+        self.generation:int = 0             # tasks of an older generation are dropped
+        self._tasks = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+        self._thread.start()
+
+
+    def schedule(self, tasks:typing.List[typing.Tuple[tuple, typing.Callable[[], Image.Image]]]) -> None:
+        """ Queues (cache key, render function) tasks, in order of priority.
+        """
+
+        self.cancel()
+
+        for key, render in tasks:
+            self._tasks.put((self.generation, key, render))
+
+
+    def cancel(self) -> None:
+        self.generation += 1
+
+
+    def _run(self) -> None:
+
+        while True:
+            generation, key, render = self._tasks.get()
+
+            if generation != self.generation or key in self.cache:
+                continue
+
+            try:
+                img = render()
+            except Exception as e:
+                logger.debug(f'Prefetch of {key[:2]} failed: {repr(e)}')
+                continue
+
+            # the render function returns None if the doc changed under it
+            if img is not None:
+                self.cache.put(key, img)
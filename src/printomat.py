@@ -2,9 +2,16 @@ import tkinter as tk
 from tkinter import ttk
 from logger import logger
 import os
-from PIL import Image, ImageTk, ImageOps
+from PIL import Image, ImageTk
 from guielements import *
 from pdftools import PDFModifier
+from sessions import DocumentSessions
+from conversion import ConversionPool
+from registry import registry, register_test_entry
+from storage import storage
+from spooler import Spooler, PrintJob, JOB_FAILED
+from preview import PreviewCache, Prefetcher, render_preview, render_file_preview, load_thumbnail
+from pdftools import file_version
 from constants import *
 
 import subprocess
@@ -48,6 +55,15 @@ class Printomat(tk.Tk):
         self.prev_no_sel_itm:int = 0
         
         self.pdf_obj:PDFModifier = None        
+        self.doc_sessions:DocumentSessions = None   # the open docs of the entry
+        self.conversion_pool = ConversionPool()
+        self.preview_cache = PreviewCache()
+        self.prefetcher = Prefetcher(self.preview_cache)
+        self.prefetch_flag:str = None
+        self.open_flag:str = None               # opening of the doc shown from its thumbnail
+        self.spooler = Spooler(self.conversion_pool)
+        self.print_jobs:List[PrintJob] = []     # jobs of the current user
+        self.print_flag:str = None
         
         self.fileOptions:List[FileOptions] = []
 
@@ -77,6 +93,9 @@ class Printomat(tk.Tk):
 
         self.mainloop()
 
+        self.close_entry()
+        self.conversion_pool.shutdown(wait=False)
+
 
     def reset_timer(self, event = None):
         """ Callback function on every Left mouse Button.
@@ -102,7 +121,12 @@ class Printomat(tk.Tk):
 
         # Destroy previous widgets so we have a clean interface when timeout occurs
         self.destroy_all_widgets()
+        self.cancel_prefetch()
+        self.cancel_open()
+        self.cancel_print_poll()
+        self.close_entry()
         self.pdf_obj = None
+        self.preview_cache.clear()
         self.tries = 0
         
         self.top_container = ttk.Frame(self)
@@ -134,6 +158,22 @@ class Printomat(tk.Tk):
         self.kbd = Keyboard(master=self.keyboardFrame, row_i=0)
 
 
+    def close_entry(self) -> None:
+        """ Releases the entry for eviction and accounts the files written while it was open.
+        """
+
+        if self.entry_dir is None:
+            return
+
+        if self.doc_sessions is not None:
+            self.doc_sessions.close()
+            self.doc_sessions = None
+
+        registry.set_in_use(os.path.basename(self.entry_dir), False)
+        storage.refresh(self.entry_dir)
+        self.entry_dir = None
+
+
     def second_screen(self) -> None:
         """ Second screen that is accessed if an imput string is equal to a folder name.
         """
@@ -154,9 +194,10 @@ class Printomat(tk.Tk):
         self.fileList_container.grid(row = 0, column=0)
 
         self.fileList = FileListbox(self.fileList_container, self.files_found, self.entry_dir, 
-                                    self.fileOptions, height = 6)
+                                    self.fileOptions, self.conversion_pool, height = 6)
         self.fileList.grid(column=0, row=0)
         self.fileList.update_idletasks()
+        self.doc_sessions = DocumentSessions(self.entry_dir, self.preview_page)
  
         self.fileList.no_sel_itm.trace_add('write', lambda *args: self.preview_file())
                                                                                
@@ -164,13 +205,23 @@ class Printomat(tk.Tk):
         self.scrollbar.grid(column=1, row=0, sticky='NS')
         self.fileList.configure(yscrollcommand=self.scrollbar.set)
 
+        # shown only while some of the files are still being converted
+        self.progress_bar = ttk.Progressbar(master=self.fileList_container, variable=self.fileList.progress,
+                                            mode='determinate', maximum=100)
+        self.progress_bar.grid(column=0, row=1, columnspan=2, sticky='EW', pady=(10, 0))
+        self.fileList.progress.trace_add('write', lambda *args: self.update_progress())
+        self.update_progress()
+
         self.print_btn = ttk.Button(master=self.fileList_container, style='Accent.TButton', 
-                                    text='No documents selected', state='disabled')
-        self.print_btn.grid(column=0, row=1, columnspan=2, sticky='NSEW', pady=10)
+                                    text='No documents selected', state='disabled', command=self.print_documents)
+        self.print_btn.grid(column=0, row=2, columnspan=2, sticky='NSEW', pady=10)
 
         self.exit_btn = ttk.Button(master=self.fileList_container, style='Clear.TButton',
                                    text='Exit', command=self.first_screen)
-        self.exit_btn.grid(column=0, row = 2, columnspan=2, sticky='NSEW')
+        self.exit_btn.grid(column=0, row = 3, columnspan=2, sticky='NSEW')
+
+        self.print_status = ttk.Label(master=self.fileList_container, font=('Helvetica', 16), anchor='center')
+        self.print_status.grid(column=0, row=4, columnspan=2, sticky='EW', pady=(10, 0))
 
         self.docFrame = ttk.Frame(master=self.preview_column)
         self.docFrame.grid(row=0, column=0)
@@ -222,7 +273,8 @@ class Printomat(tk.Tk):
                                         textvariable=self.color, offvalue='Grayscale', onvalue='Color', command=self.set_color)
         self.color_sw.grid(column=0, row=0, sticky='W', pady=7)
         self.both_sides_sw = ttk.Checkbutton(master=self.switches_container, style='Switch.TCheckbutton', variable=self.both_sides,
-                                             textvariable=self.both_sides, offvalue='Print one side', onvalue='Print both sides')
+                                             textvariable=self.both_sides, offvalue='Print one side', onvalue='Print both sides',
+                                             command=self.set_both_sides)
         self.both_sides_sw.grid(column=0, row=1, sticky='W', pady=7)
         self.orientation_sw = ttk.Checkbutton(master=self.switches_container, style='Switch.TCheckbutton', variable=self.orientation,
                                               offvalue='Landscape', onvalue='Portrait', textvariable=self.orientation, command=self.set_orientation)
@@ -259,10 +311,13 @@ class Printomat(tk.Tk):
         self.c_state(self.fileOptions_column, 'disabled')
 
 
-    def preview_file(self, pdf_is_modified = False, reset_pdf = False) -> None:
-        """ Displays a preview of the selected file in a tk.Canvas.
+    def preview_file(self, pdf_is_modified = False, reset_pdf = False, open_doc = False) -> None:
+        """ Displays a preview of the selected file in a tk.Canvas. A file that is not open
+            yet is first shown from its thumbnail, and opened right after (open_doc = True).
         """
 
+        self.cancel_prefetch()
+        self.cancel_open()
         no_sel_itm = self.fileList.no_sel_itm.get()
 
         # if at least a file is selected
@@ -276,31 +331,33 @@ class Printomat(tk.Tk):
 
             # if a file is deselected
             else:
-                # if another file has been deselected than the one in focus
-                # delete the pdf_obj so that it can be saved and its new name updated in fileList
-                #if pdf_is_modified is False:
-                if pdf_is_modified is False and self.pdf_obj is not None:
-                    self.pdf_obj.__del__(increase_extension=True)
                 self.f_selected = self.fileList.selected_item('previous')
                 self.f_name = self.fileList.selected_item_name('previous')
                 self.f_iid = self.fileList.selected_item_index('previous')
 
-            # create a new PDF object only if one does not yet exist
-            # otherwise we will use the one already created and display the changes
+            # the doc of the selected file is taken from the open docs, or opened
+            # if only the options changed, the doc in focus is kept and displays the changes
             if pdf_is_modified is False:
-                # make sure we call the destructor!! __del__ is not automatically called
-                if self.pdf_obj is not None:
-                    if reset_pdf == True:
-                        self.pdf_obj.__del__(increase_extension=False)
-                    else:
-                        self.pdf_obj.__del__(increase_extension=True)
-                self.pdf_obj = PDFModifier(self.entry_dir, self.f_selected, self.fileList)
                 if reset_pdf == True:
-                    self.fileOptions[self.f_iid].__init__(self.pdf_obj)
+                    self.doc_sessions.discard(self.f_iid)
+                    self.pdf_obj = self.doc_sessions.open(self.f_iid, self.f_selected)
+                    self.fileOptions[self.f_iid] = FileOptions(self.pdf_obj.get_orientation())
+                else:
+                    # the doc that loses the focus stays open, its edits are kept in its FileOptions
+                    options = self.fileOptions[self.f_iid]
+
+                    if open_doc is False and self.doc_sessions.get(self.f_iid) is None and self.preview_thumbnail(options):
+                        self.pdf_obj = None
+                        # a timer, not after_idle(), so that the thumbnail is on screen before the doc is opened
+                        self.open_flag = self.after(1, lambda: self.preview_file(open_doc=True))
+                        return
 
+                    # the doc is always opened from the '.1' file, the edits are restored from the options
+                    self.pdf_obj = self.doc_sessions.open(self.f_iid, self.f_selected, options.layout,
+                                                          'P' if options.orientation == 'Portrait' else 'L')
 
-            if (self.pdf_obj.page_count) > 1:
-                self.pdf_obj.current_page.trace_add('write', lambda *args: self.preview_page())
+
+            if (self.pdf_obj.sheet_count) > 1:
                 self.prev_page_btn.configure(command = lambda: self.prev_page_btn.prev_page(self.pdf_obj))
                 self.next_page_btn.configure(command = lambda: self.next_page_btn.next_page(self.pdf_obj))
                 self.prev_page_btn.grid()
@@ -328,10 +385,8 @@ class Printomat(tk.Tk):
             self.prev_no_sel_itm = no_sel_itm
 
         else:
-            # destroy the pdf object only if it is assgined
-            if self.pdf_obj is not None:    
-                # if the only document has been deselected delete the obj so it can be saved locally
-                self.pdf_obj.__del__(increase_extension=True)
+            # the only document has been deselected
+            self.pdf_obj = None
 
             self.docTitle.configure(text='')
             self.page_label.grid_remove()
@@ -341,22 +396,134 @@ class Printomat(tk.Tk):
             self.canvas_default()
     
 
+    def update_progress(self) -> None:
+        """ Hides the conversion progress bar once all the files are ready.
+        """
+
+        if self.fileList.progress.get() >= 100:
+            self.progress_bar.grid_remove()
+        else:
+            self.progress_bar.grid()
+
+
     def preview_page(self) -> None:
         """ Displays the current page in the Canvas
         """
 
-        self.page_label.configure(text=f'Page {self.pdf_obj.current_page.get() + 1} / {self.pdf_obj.page_count}')
-        
-        img:Image.Image = self.pdf_obj.create_img_from_pdf()
+        page_no = self.pdf_obj.current_page.get()
+        self.page_label.configure(text=f'Page {page_no + 1} / {self.pdf_obj.sheet_count}')
 
-        if self.color.get() == "Grayscale":
-            img = ImageOps.grayscale(img)
+        # rendered pages are reused when flipping back and forth or toggling the color
+        key = (self.pdf_obj.version, page_no, self.layout.get(), self.orientation.get(), self.color.get())
+        img:Image.Image = self.preview_cache.get(key)
 
-        img.thumbnail((C_WIDTH, C_HEIGHT), Image.LANCZOS)
+        if img is None:
+            img = render_preview(self.pdf_obj, page_no, self.color.get() == "Grayscale")
+            self.preview_cache.put(key, img)
 
         self.tkimg = ImageTk.PhotoImage(img)        # 'tkimg' is garbage collected after function finishes, self is needed
+        self.canvas.delete('all')
         self.canvas.create_image(C_WIDTH/2 + 2, C_HEIGHT/2 + 2, anchor=tk.CENTER, image=self.tkimg)
 
+        self.cancel_prefetch()
+        self.prefetch_flag = self.after(PREFETCH_DELAY, self.prefetch)
+
+
+    def preview_thumbnail(self, options:FileOptions) -> bool:
+        """ Displays the thumbnail written by the conversion if the file is previewed with
+            the default options, the ones it was rendered with. It is also put in the preview
+            cache, so that the first sheet is not rendered again once the doc is open.
+            The FileOptions stay disabled until then. Returns False if there is no thumbnail.
+        """
+
+        file = os.path.splitext(self.f_selected)[0] + '.1'
+        thumbnail = load_thumbnail(self.entry_dir, file)
+        if thumbnail is None:
+            return False
+
+        img, page_count, orientation = thumbnail
+        if (options.layout, options.orientation, options.color) != (1, 'Portrait' if orientation == 'P' else 'Landscape', 'Color'):
+            return False
+
+        # same key as the one preview_page() looks up once the doc is open
+        version = file_version(os.path.join(self.entry_dir, file)) + (1, orientation)
+        self.preview_cache.put((version, 0, options.layout, options.orientation, options.color), img)
+
+        self.docTitle.configure(text = self.f_name[:35] + (self.f_name[35:] and '...'))
+        self.page_label.configure(text=f'Page 1 / {page_count}')
+        self.page_label.grid()
+        self.prev_page_btn.grid_remove()
+        self.next_page_btn.grid_remove()
+        self.c_state(self.fileOptions_column, 'disabled')
+
+        self.tkimg = ImageTk.PhotoImage(img)
+        self.canvas.delete('all')
+        self.canvas.create_image(C_WIDTH/2 + 2, C_HEIGHT/2 + 2, anchor=tk.CENTER, image=self.tkimg)
+
+        return True
+
+
+    def prefetch(self) -> None:
+        """ Once the user is idle, renders the neighbouring pages of the current doc
+            and the first page of the other selected files into the preview cache.
+        """
+
+        self.prefetch_flag = None
+        pdf_obj = self.pdf_obj
+        page_no = pdf_obj.current_page.get()
+        grayscale = self.color.get() == "Grayscale"
+        tasks = []
+
+        for n in (page_no + 1, page_no - 1):
+            if 0 <= n < pdf_obj.sheet_count:
+                key = (pdf_obj.version, n, self.layout.get(), self.orientation.get(), self.color.get())
+                tasks.append((key, lambda n=n, version=pdf_obj.version:
+                              render_preview(pdf_obj, n, grayscale, version)))
+
+        for iid in self.fileList.selection():
+            if int(iid) == self.f_iid:
+                continue
+
+            file = self.fileList.item(iid)['text']
+            options = self.fileOptions[int(iid)]
+            orientation = 'P' if options.orientation == 'Portrait' else 'L'
+
+            # a file selected before is still open, it is rendered without parsing it again
+            open_obj = self.doc_sessions.get(int(iid))
+            if open_obj is not None:
+                key = (open_obj.version, 0, options.layout, options.orientation, options.color)
+                tasks.append((key, lambda open_obj=open_obj, version=open_obj.version,
+                              grayscale=options.color == "Grayscale":
+                              render_preview(open_obj, 0, grayscale, version)))
+                continue
+
+            # same version as the one of the PDFModifier that will be opened for this file
+            version = file_version(os.path.join(self.entry_dir, os.path.splitext(file)[0] + '.1'))
+            version += (options.layout, orientation)
+            key = (version, 0, options.layout, options.orientation, options.color)
+            tasks.append((key, lambda file=file, layout=options.layout, orientation=orientation,
+                          grayscale=options.color == "Grayscale":
+                          render_file_preview(self.entry_dir, file, layout, orientation, grayscale)))
+
+        self.prefetcher.schedule(tasks)
+
+
+    def cancel_prefetch(self) -> None:
+        """ Drops the pending prefetch work, called when the selection or the options change.
+        """
+
+        if self.prefetch_flag is not None:
+            self.after_cancel(self.prefetch_flag)
+            self.prefetch_flag = None
+        self.prefetcher.cancel()
+
+
+    def cancel_open(self) -> None:
+
+        if self.open_flag is not None:
+            self.after_cancel(self.open_flag)
+            self.open_flag = None
+
 
     def canvas_default(self) -> None:
         """ Creates a Canvas used no files are selected.
@@ -375,9 +542,6 @@ class Printomat(tk.Tk):
     def reset_doc(self):
         """ Resets the pdf document to the original state. """
 
-        # se the 'text' option of the FileListbox to the initial value ending in .1
-        self.fileList.item(self.f_iid, text = self.pdf_obj.get_f_name + '.1')
-
         # preview the file with the 'reset_pdf' as True
         self.preview_file(reset_pdf = True)
         
@@ -417,6 +581,61 @@ class Printomat(tk.Tk):
         self.preview_page()
 
 
+    def set_both_sides(self):
+        
+        self.fileOptions[self.f_iid].both_sides = self.both_sides.get()
+
+
+    def print_documents(self) -> None:
+        """ Queues the print jobs of the selected files. With PRINT_MERGE_JOBS the files
+            with compatible options share a job, so the printer is set up once for them.
+            The spooler renders and sends the jobs in the background, their state is
+            polled into the print_status label.
+        """
+
+        # the status is of the jobs of this press, the earlier ones keep printing
+        self.cancel_print_poll()
+        jobs:List[PrintJob] = []
+
+        for iid in self.fileList.selection():
+            file, options = self.fileList.item(iid)['text'], self.fileOptions[int(iid)]
+
+            if PRINT_MERGE_JOBS is True and any(job.merge(file, options) for job in jobs):
+                continue
+            jobs.append(PrintJob(self.entry_dir, file, options))
+
+        for job in jobs:
+            logger.info(f'Print job {job.job_id} queued for {[document[0] for document in job.documents]}')
+            self.print_jobs.append(self.spooler.submit(job))
+
+        self.poll_print_jobs()
+
+
+    def poll_print_jobs(self) -> None:
+        
+        finished = sum(job.finished for job in self.print_jobs)
+        failed = sum(job.state == JOB_FAILED for job in self.print_jobs)
+        total = len(self.print_jobs)
+
+        if finished < total:
+            self.print_status.configure(text=f'Printing {finished + 1} / {total} ...')
+            self.print_flag = self.after(SPOOLER_POLL_INTERVAL, self.poll_print_jobs)
+        else:
+            self.print_status.configure(text=f'{failed} / {total} failed, please ask for help' if failed
+                                        else f'{total} sent to the printer')
+            self.print_flag = None
+
+
+    def cancel_print_poll(self) -> None:
+        """ The jobs keep printing, only the polling of the user's jobs stops.
+        """
+
+        if self.print_flag is not None:
+            self.after_cancel(self.print_flag)
+            self.print_flag = None
+        self.print_jobs = []
+
+
     def set_layout(self, event:tk.Event):
         """ Sets the number of pages per sheet
         """
@@ -430,7 +649,7 @@ class Printomat(tk.Tk):
         self.pdf_obj.multiple_pages(self.layout.get())
 
         self.fileOptions[self.f_iid].orientation = ('Landscape'
-            if self.pdf_obj[0].rect.width > self.pdf_obj[0].rect.height
+            if self.pdf_obj.sheet_orientation() == 'L'
             else 'Portrait')        
         self.orientation.set(self.fileOptions[self.f_iid].orientation)
 
@@ -450,21 +669,17 @@ class Printomat(tk.Tk):
 
         if self.tries < MAX_TRIES:
             logger.debug('Entry tries: \'%s\'' % self.tries)
-            self.entry_dir = os.path.join(ENTRIES_FPATH, match_str)
-            self.files_found = []
+            # the registry is an index lookup, the entry dir is only touched once the OTP matches
+            files = registry.files(match_str)
             
-            if os.path.isdir(self.entry_dir):
+            if files is not None:
 
                 self.tries = 0
+                self.entry_dir = os.path.join(ENTRIES_FPATH, match_str)
+                self.files_found = files
+                registry.set_in_use(match_str, True)
                 logger.debug('Accessing entry -> \'%s\'' % match_str)
 
-                for file in os.listdir(self.entry_dir):
-
-                    abs_path = os.path.join(self.entry_dir, file)
-                    if any(file.endswith('.' + ext) for ext in FILE_TYPES):
-                        if not os.path.islink(abs_path) and not os.path.isdir(abs_path):
-                            self.files_found.append(file)
-
                 logger.info('Files found: %s' % self.files_found)
 
                 self.second_screen()
@@ -502,6 +717,9 @@ class Printomat(tk.Tk):
 
 
 if __name__ == "__main__":
+
+    if DEBUG is True:
+        register_test_entry()
     
     # Start the web server subprocess
     proc_ws = subprocess.Popen(['python3', os.path.join(WEBSERVER_FPATH, 'webserver.py')])
@@ -511,4 +729,8 @@ if __name__ == "__main__":
     
     # Terminate the web server subprocess when the application exits
     proc_ws.terminate()
-    proc_ws.wait() # Wait for the subprocess to finish
\ No newline at end of file
+    try:
+        proc_ws.wait(timeout=WEBSERVER_SHUTDOWN_TIMEOUT) # Wait for the in-flight uploads to finish
+    except subprocess.TimeoutExpired:
+        proc_ws.kill()
+        proc_ws.wait()
\ No newline at end of file
@@ -1,12 +1,19 @@
 import os
+import io
 import string
-from datetime import datetime, time
+import secrets
+from datetime import datetime
 import qrcode
 from logger import logger
 import shutil
 from constants import *
 from PIL import Image
 import threading
+import time
+import heapq
+import queue
+import typing
+from registry import registry
 
 
 class Entry:
@@ -14,72 +21,315 @@ class Entry:
 
     def __init__(self):
         self.length = RAND_SEQ_LENGTH
-        self.generate_random_no_str(RAND_SEQ_LENGTH)
+        self._genStr = code_allocator.allocate()
+        self._qr = None
+
+        # the registry refuses an OTP in use by another process
+        created = time.time()
+        while not registry.add_entry(self.genStr, created):
+            self._genStr = code_allocator.allocate()
+        expiry_scheduler.schedule(self.genStr, created)
 
         self.timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
         self.entry_path = os.path.join(ENTRIES_FPATH, self.genStr)
-        self._qr = self.createQR()
+        if not os.path.exists(self.entry_path):
+            os.makedirs(self.entry_path)
         Entry.counter += 1
         logger.info("Created new Entry -> %s RandomSeq -> '%s'" % (Entry.counter, self.genStr))
 
-    def generate_random_string(self, length: int) -> str:
-        self._genStr = ''.join([string.ascii_uppercase[int.from_bytes(os.urandom(1), byteorder='big') 
-                                         % len(string.ascii_uppercase)] for _ in range(length)])
-        return self._genStr
-    
-    def generate_random_no_str(self, length: int) -> str:
-        self._genStr = ''.join([(string.ascii_uppercase+string.digits)[int.from_bytes(os.urandom(1), byteorder='big') 
-                                         % len(string.ascii_uppercase + string.digits)] for _ in range(length)])
-        return self._genStr
-    
     @property
     def genStr(self) -> str:
         return self._genStr
     
     @property
     def qr(self) -> Image:
+        if self._qr is None:
+            self._qr = self.createQR()
         return self._qr
 
+    @property
+    def qr_data(self) -> bytes:
+        """ The QR image encoded as QR_FORMAT, usually precomputed.
+        """
+
+        return code_allocator.qr_image(self.genStr)
+
     def createQR(self) -> Image:
-        qr = qrcode.QRCode(
-            version=1,
-            box_size=10,
-            border=3
-            )        
-        qr.add_data(self.genStr)
-        qr.make(fit=True)
-        if not os.path.exists(self.entry_path):
-            os.makedirs(self.entry_path)
-        # returns <class 'qrcode.image.pil.PilImage'>
-        return qr.make_image(fill_color="black", back_color="white")
+        return make_qr(self.genStr)
+
+
+def make_qr(code: str) -> Image:
+    qr = qrcode.QRCode(
+        version=1,
+        box_size=10,
+        border=3
+        )        
+    qr.add_data(code)
+    qr.make(fit=True)
+    # returns <class 'qrcode.image.pil.PilImage'>
+    return qr.make_image(fill_color="black", back_color="white")
+
+
+def encode_qr(code: str, fmt: str = QR_FORMAT) -> bytes:
+    """ The QR image of the code as PNG or SVG bytes.
+    """
+
+    if fmt == 'png':
+        buf = io.BytesIO()
+        make_qr(code).save(buf, format='PNG')
+        return buf.getvalue()
+
+    qr = qrcode.QRCode(version=1, border=3)
+    qr.add_data(code)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()    # includes the border
+
+    # one subpath per horizontal run of dark modules
+    path = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < len(row):
+            if row[x]:
+                run = 1
+                while x + run < len(row) and row[x + run]:
+                    run += 1
+                path.append(f'M{x} {y}h{run}v1h-{run}z')
+                x += run
+            else:
+                x += 1
+
+    size = len(matrix)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+            f'<rect width="{size}" height="{size}" fill="#fff"/><path d="{"".join(path)}"/></svg>').encode()
+
+
+class CodeAllocator():
+    """ Draws the OTPs from os.urandom() read in batches. Bytes that would bias the
+        modulo (>= 252 for 36 symbols) are rejected. The codes in use are kept in a set,
+        and a background thread keeps a pool of fresh codes with their encoded QR images
+        ready so an upload doesn't pay for generating them. The images of the codes
+        in use are kept until the code is released.
+    """
+
+    ALPHABET = string.ascii_uppercase + string.digits
+
+    def __init__(self, length: int = RAND_SEQ_LENGTH, pool_size: int = CODE_POOL_SIZE):
+        self.length = length
+        self.live: typing.Set[str] = set()     # codes of the entries and of the pool
+        self.qr_images: typing.Dict[str, bytes] = {}
+        self.qr_tokens: typing.Dict[str, str] = {}     # token -> code, the QR images are only served by token
+        self._limit = 256 - 256 % len(CodeAllocator.ALPHABET)
+        self._random = b''
+        self._pool = queue.Queue(pool_size)
+        self._lock = threading.Lock()
+        self._thread: threading.Thread = None
+
+    def start(self) -> None:
+        """ Loads the codes in use from the registry and starts filling the pool.
+        """
+
+        with self._lock:
+            self.live.update(otp for otp, _ in registry.entries())
+
+        self._thread = threading.Thread(target=self._fill, name='codes', daemon=True)
+        self._thread.start()
+
+    def allocate(self) -> str:
+        """ A code from the pool, or a new one if the pool is empty.
+        """
+
+        try:
+            code, qr_image = self._pool.get_nowait()
+            self.qr_images[code] = qr_image
+            return code
+        except queue.Empty:
+            return self.new_code()
+
+    def qr_image(self, code: str) -> typing.Optional[bytes]:
+        """ Encoded QR image of a code in use, None for unknown codes.
+        """
+
+        qr_image = self.qr_images.get(code)
+
+        if qr_image is None and code in self.live:
+            qr_image = self.qr_images[code] = encode_qr(code)
+
+        return qr_image
+
+    def qr_token(self, code: str) -> str:
+        """ Unguessable name of the QR image of an entry's code, given to its uploader only,
+            so that the QR URLs can't be used to find out which codes are in use.
+        """
+
+        token = secrets.token_urlsafe(16)
+        with self._lock:
+            self.qr_tokens[token] = code
+        return token
+
+    def code_of(self, token: str) -> typing.Optional[str]:
+        return self.qr_tokens.get(token)
+
+    def release(self, code: str) -> None:
+        with self._lock:
+            self.live.discard(code)
+            self.qr_images.pop(code, None)
+            self.qr_tokens = {token: token_code for token, token_code in self.qr_tokens.items() if token_code != code}
+
+    def new_code(self) -> str:
+        with self._lock:
+            while True:
+                code = ''.join(CodeAllocator.ALPHABET[byte % len(CodeAllocator.ALPHABET)]
+                               for byte in self._random_bytes(self.length))
+                if code not in self.live:
+                    self.live.add(code)
+                    return code
+
+    def _random_bytes(self, n: int) -> bytes:
+        """ n unbiased bytes, all lower than the limit.
+        """
+
+        while len(self._random) < n:
+            self._random += bytes(byte for byte in os.urandom(CODE_RANDOM_BATCH) if byte < self._limit)
+
+        random, self._random = self._random[:n], self._random[n:]
+        return random
+
+    def _fill(self) -> None:
+
+        while True:
+            code = self.new_code()
+            # blocks while the pool is full
+            self._pool.put((code, encode_qr(code)))
 
 
 class Cleaner():
-    def clean_old_entries(self, interval: int) -> None:
-        
+    def clean_unregistered_entries(self, interval: int) -> None:
+        """ Removes the old folders the registry doesn't know about, e.g. left from before it existed.
+        """
+
         current_Unix_time:float = datetime.timestamp(datetime.now())
+        registered = set(otp for otp, _ in registry.entries())
 
         for folder_name in os.listdir(ENTRIES_FPATH):
+            entry_path = os.path.join(ENTRIES_FPATH, folder_name)
+            if folder_name in registered or not os.path.isdir(entry_path):
+                continue
             if DEBUG is True and folder_name == "TEST1NG":
                 continue
-            entry_path = os.path.join(ENTRIES_FPATH, folder_name)
-            creation_time = os.stat(entry_path).st_ctime
-            
-            if current_Unix_time - creation_time > interval:
-                log_str = f"Removing '{folder_name}' ... "
-                try:
-                    shutil.rmtree(entry_path)
-                    log_str += ('Done')
-                except Exception as e:
-                    log_str += f'Error: {repr(e)}'
-    
-                logger.info(log_str)
 
+            if current_Unix_time - os.stat(entry_path).st_ctime > interval:
+                self.remove_entry(folder_name)
+
+    def remove_entry(self, otp: str) -> None:
+        entry_path = os.path.join(ENTRIES_FPATH, otp)
+        log_str = f"Removing '{otp}' ... "
+        try:
+            if os.path.isdir(entry_path):
+                shutil.rmtree(entry_path)
+            registry.remove_entry(otp)
+            code_allocator.release(otp)
+            log_str += ('Done')
+        except Exception as e:
+            log_str += f'Error: {repr(e)}'
+
+        logger.info(log_str)
+
+
+class ExpiryScheduler():
+    """ Removes every entry exactly ttl seconds after it was created. The deadlines are
+        kept in a heap and a single thread sleeps until the earliest one, so there is no
+        periodic scan of the entries. Started by the webserver, which creates the entries.
+        An entry open in the kiosk when it expires is checked again every
+        ENTRY_IN_USE_RETRY seconds, and removed once the kiosk has closed it.
+    """
+
+    def __init__(self, ttl: int = ENTRY_RM_INTERVAL):
+        self.ttl = ttl
+        self._heap: typing.List[typing.Tuple[float, str]] = []     # (deadline, otp)
+        self._cond = threading.Condition()
+        self._thread: threading.Thread = None
+        self._stopped = False
+
+    def start(self) -> None:
+        """ Schedules the entries already in the registry (the overdue ones are removed
+            right away) and starts the expiry thread.
+        """
+
+        Cleaner().clean_unregistered_entries(self.ttl)
+
+        with self._cond:
+            self._heap = [(created + self.ttl, otp) for otp, created in registry.entries()]
+            heapq.heapify(self._heap)
+
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='expiry', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def schedule(self, otp: str, created: float) -> None:
+        self._push(created + self.ttl, otp)
+
+    def _push(self, deadline: float, otp: str) -> None:
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, otp))
+            # wake the thread up in case this is the earliest deadline
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        """ Live entries, bytes they hold and seconds until the next removal.
+        """
+
+        live_entries, bytes_held = registry.totals()
+
+        with self._cond:
+            next_expiry = max(0, self._heap[0][0] - time.time()) if self._heap else None
+
+        return dict(live_entries=live_entries, bytes_held=bytes_held, next_expiry=next_expiry)
+
+    def _next_due(self) -> typing.Optional[str]:
+        """ Waits for the earliest deadline, returns its OTP or None once stopped.
+        """
+
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                deadline, otp = self._heap[0]
+                delay = deadline - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+                return otp
+
+        return None
+
+    def _run(self) -> None:
+
+        while (otp := self._next_due()) is not None:
+            if DEBUG is True and otp == "TEST1NG":
+                continue
+
+            # the entry may have been discarded, or its OTP reused by a newer entry
+            created = registry.created(otp)
+            if created is None or created + self.ttl > time.time():
+                continue
+
+            # the kiosk clears in_use when the user is done with the entry
+            if registry.in_use(otp):
+                self._push(time.time() + ENTRY_IN_USE_RETRY, otp)
+                continue
+
+            Cleaner().remove_entry(otp)
+            logger.debug(f"Entries: {self.stats()}")
 
-def remove_entries():
-    Cleaner().clean_old_entries(ENTRY_RM_INTERVAL)
-    cleaner_thread = threading.Timer(ENTRY_RM_INTERVAL, remove_entries)
-    cleaner_thread.daemon = True
-    cleaner_thread.start()
 
-remove_entries()
\ No newline at end of file
+expiry_scheduler = ExpiryScheduler()
+code_allocator = CodeAllocator()
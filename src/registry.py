@@ -0,0 +1,184 @@
+import sqlite3
+import os
+import threading
+import json
+import time
+import typing
+from constants import *
+
+
+
+class EntryRegistry:
+    """ Index of the entries shared by the webserver and the kiosk, in a small SQLite db.
+        Holds the OTP and creation time of each entry and the files with their
+        conversion status, so an OTP is looked up without touching the entries dir.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            otp TEXT PRIMARY KEY,
+            created REAL NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            in_use INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS entries_created ON entries (created);
+        CREATE TABLE IF NOT EXISTS files (
+            otp TEXT NOT NULL REFERENCES entries (otp) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            state TEXT,
+            info TEXT,
+            PRIMARY KEY (otp, name)
+        );
+    """
+
+
+    def __init__(self, db_path:str = REGISTRY_FPATH):
+        self.db_path:str = db_path
+        self._local = threading.local()     # sqlite connections can't be shared between threads
+
+
+    def add_entry(self, otp:str, created:float = None) -> bool:
+        """ Returns False if the OTP is already taken.
+        """
+
+        with self._conn() as conn:
+            cursor = conn.execute('INSERT OR IGNORE INTO entries (otp, created) VALUES (?, ?)',
+                                  (otp, created if created is not None else time.time()))
+            return cursor.rowcount == 1
+
+
+    def remove_entry(self, otp:str) -> None:
+        with self._conn() as conn:
+            conn.execute('DELETE FROM entries WHERE otp = ?', (otp,))
+
+
+    def add_files(self, otp:str, files:typing.Iterable[str]) -> None:
+        with self._conn() as conn:
+            conn.executemany('INSERT OR IGNORE INTO files (otp, name) VALUES (?, ?)',
+                             [(otp, file) for file in files])
+
+
+    def files(self, otp:str) -> typing.Optional[typing.List[str]]:
+        """ Files of the entry in upload order, None if there is no such entry.
+        """
+
+        conn = self._conn()
+        if conn.execute('SELECT 1 FROM entries WHERE otp = ?', (otp,)).fetchone() is None:
+            return None
+
+        return [name for name, in conn.execute('SELECT name FROM files WHERE otp = ? ORDER BY rowid', (otp,))]
+
+
+    def entries(self) -> typing.List[typing.Tuple[str, float]]:
+        """ (OTP, creation time) of all the entries, oldest first.
+        """
+
+        return self._conn().execute('SELECT otp, created FROM entries ORDER BY created').fetchall()
+
+
+    def created(self, otp:str) -> typing.Optional[float]:
+        row = self._conn().execute('SELECT created FROM entries WHERE otp = ?', (otp,)).fetchone()
+        return row[0] if row is not None else None
+
+
+    def set_size(self, otp:str, size:int) -> None:
+        """ Records the bytes held by the entry dir.
+        """
+
+        with self._conn() as conn:
+            conn.execute('UPDATE entries SET size = ? WHERE otp = ?', (size, otp))
+
+
+    def set_in_use(self, otp:str, in_use:bool) -> None:
+        """ Set by the kiosk while the entry is open, such entries are never evicted.
+        """
+
+        with self._conn() as conn:
+            conn.execute('UPDATE entries SET in_use = ? WHERE otp = ?', (int(in_use), otp))
+
+
+    def in_use(self, otp:str) -> bool:
+        row = self._conn().execute('SELECT in_use FROM entries WHERE otp = ?', (otp,)).fetchone()
+        return row is not None and row[0] == 1
+
+
+    def evictable(self) -> typing.List[typing.Tuple[str, int]]:
+        """ OTPs and sizes of the entries not open in the kiosk, oldest first.
+        """
+
+        return self._conn().execute('SELECT otp, size FROM entries WHERE in_use = 0 ORDER BY created').fetchall()
+
+
+    def totals(self) -> typing.Tuple[int, int]:
+        """ Number of entries and bytes they hold.
+        """
+
+        return self._conn().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+
+
+    def status(self, otp:str) -> dict:
+        """ Conversion status of the files of the entry, the ones without a status are left out.
+        """
+
+        rows = self._conn().execute('SELECT name, state, info FROM files WHERE otp = ? AND state IS NOT NULL', (otp,))
+        return {name: dict(state=state, **json.loads(info)) for name, state, info in rows}
+
+
+    def set_status(self, otp:str, files:typing.Iterable[str], state:str, **info) -> None:
+        """ Records the same state for one or more files, adding the files that are not listed yet.
+        """
+
+        with self._conn() as conn:
+            conn.executemany('INSERT INTO files (otp, name, state, info) VALUES (?, ?, ?, ?) '
+                             'ON CONFLICT (otp, name) DO UPDATE SET state = excluded.state, info = excluded.info',
+                             [(otp, file, state, json.dumps(info)) for file in files])
+
+
+    def clear_status(self, otp:str, files:typing.Iterable[str]) -> None:
+        with self._conn() as conn:
+            conn.executemany('UPDATE files SET state = NULL, info = NULL WHERE otp = ? AND name = ?',
+                             [(otp, file) for file in files])
+
+
+    def _conn(self) -> sqlite3.Connection:
+        """ Connection of the calling thread, opened on first use. WAL lets the kiosk
+            read while the webserver writes.
+        """
+
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA foreign_keys = ON')
+            conn.executescript(EntryRegistry.SCHEMA)
+            self._local.conn = conn
+
+        return conn
+
+
+
+registry = EntryRegistry()
+
+
+def register_test_entry() -> None:
+    """ The TEST1NG entry ships with the repo, its files are registered as found on disk.
+    """
+
+    entry_path = os.path.join(ENTRIES_FPATH, "TEST1NG")
+    names = set(os.listdir(entry_path))
+    files = []
+
+    for file in sorted(names):
+        abs_path = os.path.join(entry_path, file)
+        # the files written by the kiosk are named after their upload: 'a.pdf.1', 'a.pdf.1.thumb', ...
+        parts = file.split('.')
+        if any('.'.join(parts[:i]) in names for i in range(1, len(parts))):
+            continue
+        if any(file.endswith('.' + ext) for ext in FILE_TYPES):
+            if not os.path.islink(abs_path) and not os.path.isdir(abs_path):
+                files.append(file)
+
+    registry.add_entry("TEST1NG")
+    registry.add_files("TEST1NG", files)
@@ -0,0 +1,64 @@
+import typing
+from collections import OrderedDict
+from logger import logger
+from pdftools import PDFModifier
+from constants import *
+
+
+
+class DocumentSessions:
+    """ The docs of the entry open in the kiosk, a bounded pool of PDFModifiers keyed by
+        their FileListbox iid, in LRU order of selection. Selecting a file again reuses its
+        open doc instead of parsing it again. Nothing is saved, the edits live in the
+        FileOptions and are applied to the '.1' file when the doc is opened or printed.
+        The least recently selected docs are released past DOC_SESSIONS.
+    """
+
+    def __init__(self, entry_dir:str, on_page:typing.Callable[[], None], size:int = DOC_SESSIONS):
+        self.entry_dir:str = entry_dir
+        self.on_page = on_page              # called when the current page of a doc changes
+        self.size:int = size
+
+        self._docs:OrderedDict = OrderedDict()      # iid -> PDFModifier
+
+
+    def get(self, iid:int) -> typing.Optional[PDFModifier]:
+        return self._docs.get(iid)
+
+
+    def open(self, iid:int, file:str, layout:int = 1, orientation:str = None) -> PDFModifier:
+        """ Returns the open doc of the item, or opens it with the given edits.
+        """
+
+        pdf_obj = self._docs.get(iid)
+
+        if pdf_obj is not None:
+            self._docs.move_to_end(iid)
+            return pdf_obj
+
+        pdf_obj = PDFModifier(self.entry_dir, file, layout, orientation)
+        pdf_obj.current_page.trace_add('write', lambda *args: self.on_page())
+        self._docs[iid] = pdf_obj
+
+        while len(self._docs) > self.size:
+            _, evicted = self._docs.popitem(last=False)
+            logger.debug(f'Releasing \'{evicted.file}\'')
+            evicted.release()
+
+        return pdf_obj
+
+
+    def discard(self, iid:int) -> None:
+        """ Releases the doc, it is opened again from the '.1' file.
+        """
+
+        pdf_obj = self._docs.pop(iid, None)
+
+        if pdf_obj is not None:
+            pdf_obj.release()
+
+
+    def close(self) -> None:
+
+        while self._docs:
+            self._docs.popitem(last=False)[1].release()
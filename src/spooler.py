@@ -0,0 +1,234 @@
+import os
+import re
+import json
+import shutil
+import subprocess
+import threading
+import queue
+import itertools
+import typing
+from logger import logger
+from pdftools import PDFLayout, PrintWriter
+from conversion import ConversionPool
+from constants import *
+
+
+JOB_QUEUED = 'queued'
+JOB_RENDERING = 'rendering'
+JOB_SENDING = 'sending'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+
+def render_job(entry_dir:str, documents:typing.List[typing.Tuple[str, int, str]], grayscale:bool,
+               duplex:bool, copies:int, f_path:str) -> typing.Tuple[str, int]:
+    """ Writes the print-ready PDF of one or more documents (file, layout, orientation) to
+        f_path and returns it with its sheet count. The sheets of each document are appended
+        to the job doc as they are built, the documents are never copied whole.
+        Runs as a job in the process pool so that the rendering of a long job doesn't hold
+        the kiosk's GIL. The copies are not duplicated in the doc, they are collated by the
+        printer, but in duplex every document and every copy starts on the front of a sheet.
+    """
+
+    out = PrintWriter(f_path)
+
+    for doc_no, (file, layout, orientation) in enumerate(documents):
+        last = doc_no == len(documents) - 1
+        pdf_obj = PDFLayout(entry_dir, file, layout, orientation)
+        try:
+            pdf_obj.add_print_sheets(out, grayscale, 2 if duplex and (copies > 1 or not last) else 1)
+        finally:
+            pdf_obj.close()
+
+    sheets = out.page_count
+    out.close()
+
+    return f_path, sheets
+
+
+
+class PrintJob:
+    """ One or more files to print with the FileOptions they were set up with. Files
+        with compatible options (see merge()) share a job. The state is updated by the
+        Spooler thread and polled by the kiosk.
+    """
+
+    counter = itertools.count(1)
+
+
+    def __init__(self, entry_dir:str, file:str, options):
+        self.job_id:int = next(PrintJob.counter)
+        self.entry_dir:str = entry_dir
+        self.copies:int = options.no_copies
+        self.color:bool = options.color == 'Color'
+        self.duplex:bool = options.both_sides == 'Print both sides'
+        self.orientation:str = self._orientation(options)   # of the first document, sets the duplex binding edge
+
+        # (file, layout, orientation) of each document, the options are applied to the '.1' file
+        self.documents:typing.List[typing.Tuple[str, int, str]] = []
+        self.add(file, options)
+
+        self.state:str = JOB_QUEUED
+        self.error:str = None
+        self.f_path:str = None              # the rendered document in the spool dir
+        self.sheets:int = None              # pages of the rendered document, per copy
+        self.printer_id:str = None          # id of the job given by the backend
+
+
+    @property
+    def file(self) -> str:
+        return self.documents[0][0]
+
+
+    @property
+    def title(self) -> str:
+        # 'report.pdf.1' -> 'report', 'report+2' if two more files are merged
+        title = os.path.splitext(os.path.splitext(self.file)[0])[0]
+        return title if len(self.documents) == 1 else f'{title}+{len(self.documents) - 1}'
+
+
+    @property
+    def finished(self) -> bool:
+        return self.state in (JOB_DONE, JOB_FAILED)
+
+
+    def add(self, file:str, options) -> None:
+        self.documents.append((file, options.layout, self._orientation(options)))
+
+
+    def merge(self, file:str, options) -> bool:
+        """ Adds the file to the job if it is printed with the same job attributes.
+            Layout and orientation are applied per document, but duplex documents must
+            share the binding edge. Returns False if the file needs its own job.
+        """
+
+        duplex = options.both_sides == 'Print both sides'
+
+        if (options.no_copies, options.color == 'Color', duplex) != (self.copies, self.color, self.duplex):
+            return False
+        if duplex and self._orientation(options) != self.orientation:
+            return False
+
+        self.add(file, options)
+        return True
+
+
+    def _orientation(self, options) -> str:
+        return 'P' if options.orientation == 'Portrait' else 'L'
+
+
+
+class LpBackend:
+    """ Submits the jobs to CUPS with lp. The options are passed as IPP job attributes.
+    """
+
+    def __init__(self, printer:str = PRINTER_NAME):
+        self.printer:str = printer
+
+
+    def submit(self, job:PrintJob) -> str:
+
+        # a landscape sheet is bound on its short edge
+        sides = 'one-sided'
+        if job.duplex:
+            sides = 'two-sided-long-edge' if job.orientation == 'P' else 'two-sided-short-edge'
+
+        cmd = ['lp', '-t', job.title, '-n', str(job.copies),
+               '-o', f'sides={sides}',
+               '-o', f'print-color-mode={"color" if job.color else "monochrome"}']
+        if job.copies > 1:
+            cmd += ['-o', 'collate=true']
+        if self.printer is not None:
+            cmd += ['-d', self.printer]
+        cmd.append(job.f_path)
+
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip() or f'lp exited with {result.returncode}')
+
+        # 'request id is printer-42 (1 file(s))'
+        match = re.search(r'request id is (\S+)', result.stdout)
+        return match.group(1) if match else result.stdout.strip()
+
+
+
+class FileSinkBackend:
+    """ Stand-in printer for testing. The jobs are copied to a dir with their attributes.
+    """
+
+    def __init__(self, sink_dir:str = PRINT_SINK_FPATH):
+        self.sink_dir:str = sink_dir
+
+
+    def submit(self, job:PrintJob) -> str:
+
+        os.makedirs(self.sink_dir, exist_ok=True)
+        name = f'{job.job_id:05d}-{job.title}'
+
+        shutil.copyfile(job.f_path, os.path.join(self.sink_dir, name + '.pdf'))
+        with open(os.path.join(self.sink_dir, name + '.json'), 'w') as f:
+            json.dump(dict(copies=job.copies, collate=job.copies > 1, color=job.color, duplex=job.duplex,
+                           documents=job.documents, sheets=job.sheets), f)
+
+        return name
+
+
+
+def get_backend(name:str = PRINTER_BACKEND) -> typing.Union[LpBackend, FileSinkBackend]:
+
+    if name == 'lp' and shutil.which('lp') is None:
+        logger.info('lp is not installed, the print jobs go to the file sink')
+        name = 'file'
+
+    return LpBackend() if name == 'lp' else FileSinkBackend()
+
+
+
+class Spooler:
+    """ Print queue of the kiosk. A background thread renders each job in the process
+        pool, submits it to the backend and records its state on the PrintJob.
+    """
+
+    def __init__(self, pool:ConversionPool, backend = None):
+        self.pool = pool
+        self.backend = backend if backend is not None else get_backend()
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='spooler', daemon=True)
+        self._thread.start()
+
+
+    def submit(self, job:PrintJob) -> PrintJob:
+        self._jobs.put(job)
+        return job
+
+
+    def _run(self) -> None:
+
+        while True:
+            job = self._jobs.get()
+            log_str = f'Print job {job.job_id} \'{job.file}\' ... '
+
+            try:
+                job.state = JOB_RENDERING
+                os.makedirs(SPOOL_FPATH, exist_ok=True)
+                job.f_path = os.path.join(SPOOL_FPATH, f'{job.job_id}.pdf')
+                _, job.sheets = self.pool.run(render_job, job.entry_dir, job.documents, not job.color,
+                                              job.duplex, job.copies, job.f_path).result()
+
+                job.state = JOB_SENDING
+                job.printer_id = self.backend.submit(job)
+                job.state = JOB_DONE
+                log_str += f'Sent as {job.printer_id}'
+
+            except Exception as e:
+                job.error = repr(e)
+                job.state = JOB_FAILED
+                log_str += f'Error: {job.error}'
+
+            finally:
+                # lp copies the file into the CUPS spool
+                if job.f_path is not None and os.path.exists(job.f_path):
+                    os.remove(job.f_path)
+
+            logger.info(log_str)
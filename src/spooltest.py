@@ -0,0 +1,114 @@
+""" Test of the print status of the kiosk. Two PDFs of TEST1NG are normalized to A4 and
+    printed with Printomat.print_documents, through a Spooler that sends the jobs to a
+    FileSinkBackend. The jobs are polled like the kiosk does (poll_print_jobs), the poll
+    must see all the jobs of the press and end with all of them sent to the printer.
+
+    python3 src/spooltest.py
+
+    Exits with 1 if the poll does not see the jobs or a job is not in the sink.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import types
+
+TEST_FILES = ['ProcSampleManuscript-A4.pdf', 'argencon_template_a4.pdf']
+TIMEOUT = 60        # seconds the jobs have to finish
+
+
+
+class Label:
+    """ Stand-in of the print_status label.
+    """
+
+    def __init__(self):
+        self.text:str = ''
+
+
+    def configure(self, text:str) -> None:
+        self.text = text
+
+
+
+class FileList:
+    """ Stand-in of the FileListbox with all its items selected.
+    """
+
+    def __init__(self, files:list):
+        self.files:list = files
+
+
+    def selection(self) -> list:
+        return [str(iid) for iid in range(len(self.files))]
+
+
+    def item(self, iid:str) -> dict:
+        return {'text': self.files[int(iid)] + '.1'}
+
+
+
+def main() -> int:
+
+    from printomat import Printomat
+    from guielements import FileOptions
+    from conversion import ConversionPool
+    from pdftools import PDFConverter
+    from spooler import Spooler, FileSinkBackend, JOB_DONE
+
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tmp', 'TEST1NG')
+    entry_dir = tempfile.mkdtemp(prefix='spooltest-')
+    sink_dir = tempfile.mkdtemp(prefix='spooltest-sink-')
+    pool = ConversionPool(1)
+    failed = False
+
+    for file in TEST_FILES:
+        shutil.copyfile(os.path.join(test_dir, file), os.path.join(entry_dir, file))
+        pdf_obj = PDFConverter(entry_dir, file)
+        try:
+            pdf_obj.check_and_resize_pdf()
+        finally:
+            pdf_obj.close()
+
+    # the kiosk without its widgets, the poll is run by hand instead of by the Tk loop
+    scheduled = []
+    kiosk = types.SimpleNamespace(entry_dir=entry_dir, fileList=FileList(TEST_FILES),
+                                  fileOptions=[FileOptions('P') for _ in TEST_FILES],
+                                  spooler=Spooler(pool, FileSinkBackend(sink_dir)),
+                                  print_status=Label(), print_jobs=[], print_flag=None,
+                                  after=lambda ms, fn: scheduled.append(fn) or len(scheduled),
+                                  after_cancel=lambda flag: None)
+    for name in ('print_documents', 'poll_print_jobs', 'cancel_print_poll'):
+        setattr(kiosk, name, types.MethodType(getattr(Printomat, name), kiosk))
+
+    try:
+        kiosk.print_documents()
+        seen = len(kiosk.print_jobs)
+        print(f'poll: {seen} job(s) of {len(TEST_FILES)} files, \'{kiosk.print_status.text}\'')
+        failed |= seen == 0
+
+        deadline = time.monotonic() + TIMEOUT
+        while kiosk.print_flag is not None and time.monotonic() < deadline:
+            time.sleep(0.1)
+            scheduled.pop()()
+
+        print(f'status: \'{kiosk.print_status.text}\'')
+        failed |= kiosk.print_flag is not None
+        failed |= any(job.state != JOB_DONE for job in kiosk.print_jobs)
+
+        sent = sorted(file for file in os.listdir(sink_dir) if file.endswith('.pdf'))
+        print(f'sink: {sent}')
+        failed |= len(sent) != len(kiosk.print_jobs) or kiosk.print_status.text != f'{seen} sent to the printer'
+
+    finally:
+        pool.shutdown()
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        shutil.rmtree(sink_dir, ignore_errors=True)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+import os
+import threading
+from logger import logger
+from registry import registry
+from rand import Cleaner
+from constants import *
+
+
+
+class StorageManager:
+    """ Keeps the entries store under a byte budget. The size of every entry is measured
+        after it changes and recorded in the registry: the uploads, their '.1' files and
+        sidecars. When an upload doesn't fit, the entries not open in the kiosk are evicted
+        whole, oldest first. An upload is refused without evicting anything if it wouldn't
+        fit even then.
+    """
+
+    def __init__(self, budget:int = STORAGE_BUDGET):
+        self.budget:int = budget
+        self.reserved:int = 0               # bytes admitted for the uploads in progress
+        self._lock = threading.Lock()
+
+
+    @property
+    def used(self) -> int:
+        return registry.totals()[1]
+
+
+    def refresh(self, entry_dir:str) -> int:
+        """ Measures the entry dir and records its size.
+        """
+
+        size = self._dir_size(entry_dir)
+        registry.set_size(os.path.basename(os.path.normpath(entry_dir)), size)
+        return size
+
+
+    def admit(self, size:int) -> bool:
+        """ Reserves room for an upload of the given size, evicting if needed.
+            Returns False if it can't fit. The reservation must be released.
+        """
+
+        size *= STORAGE_UPLOAD_FACTOR
+
+        with self._lock:
+            excess = self.used + self.reserved + size - self.budget
+
+            # the entries open in the kiosk, TEST1NG and the reservations can't be evicted
+            if excess > 0 and excess <= sum(entry_size for _, entry_size in self._evictable()):
+                self.evict(excess)
+                excess = self.used + self.reserved + size - self.budget
+
+            if excess > 0:
+                logger.info(f'Storage budget of {self.budget} bytes reached, {size} bytes refused')
+                return False
+
+            self.reserved += size
+            return True
+
+
+    def release(self, size:int) -> None:
+        with self._lock:
+            self.reserved -= size * STORAGE_UPLOAD_FACTOR
+
+
+    def evict(self, needed:int) -> int:
+        """ Frees at least the needed bytes if possible. Returns the bytes freed.
+        """
+
+        freed = 0
+
+        for otp, size in self._evictable():
+            if freed >= needed:
+                return freed
+            freed += size
+            Cleaner().remove_entry(otp)
+
+        return freed
+
+
+    def _evictable(self) -> list:
+        return [(otp, size) for otp, size in registry.evictable() if not (DEBUG is True and otp == 'TEST1NG')]
+
+
+    def _dir_size(self, entry_dir:str) -> int:
+        try:
+            return sum(file.stat().st_size for file in os.scandir(entry_dir) if file.is_file(follow_symlinks=False))
+        except FileNotFoundError:
+            return 0
+
+
+
+storage = StorageManager()
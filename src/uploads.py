@@ -0,0 +1,207 @@
+import os
+import shutil
+import typing
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.utils import secure_filename
+from logger import logger
+from rand import Entry, code_allocator
+from registry import registry
+from constants import *
+
+
+# (offset, signature, type), the types are the canonical extensions of FILE_TYPES
+MAGIC_NUMBERS = [(0, b'\xff\xd8\xff', 'jpg'),
+                 (0, b'\x89PNG\r\n\x1a\n', 'png'),
+                 (0, b'II*\x00', 'tiff'),
+                 (0, b'MM\x00*', 'tiff'),
+                 (0, b'BM', 'bmp')]
+
+EXT_ALIASES = {'jpeg': 'jpg', 'tif': 'tiff'}
+
+PART_SUFFIX = '.part'           # files still being received, not listed by the kiosk
+
+
+
+def sniff_type(head:bytes) -> typing.Optional[str]:
+    """ Detects the type of a file from its first bytes. Returns the canonical
+        extension, or None if it is not one of the supported types.
+    """
+
+    # the PDF header is allowed anywhere in the first 1024 bytes
+    if b'%PDF-' in head[:1024]:
+        return 'pdf'
+
+    for offset, signature, f_type in MAGIC_NUMBERS:
+        if head[offset:offset + len(signature)] == signature:
+            return f_type
+
+    return None
+
+
+def upload_name(filename:str, f_type:str) -> str:
+    """ Safe name for an uploaded file, with an extension that matches its detected type.
+    """
+
+    name, ext = os.path.splitext(secure_filename(filename))
+    ext = ext[1:].lower()
+
+    if ext not in FILE_TYPES or EXT_ALIASES.get(ext, ext) != f_type:
+        ext = f_type
+
+    return f'{name or "upload"}.{ext}'
+
+
+
+class UploadReceiver:
+    """ Streams a multipart/form-data upload to disk, chunk by chunk, instead of letting
+        Flask buffer the whole request. The type of each file is detected from its first
+        bytes and the unsupported ones are dropped without being written. The Entry is
+        only created once the first valid file arrives. Quotas raise RequestEntityTooLarge
+        as soon as they are exceeded, without reading the rest of the body.
+    """
+
+    def __init__(self, stream:typing.BinaryIO, boundary:bytes):
+        self.stream = stream
+        self.boundary:bytes = boundary
+        self.entry:Entry = None
+        self.files:typing.List[str] = []    # received files, still with PART_SUFFIX
+        self.parts:int = 0                  # file parts with a name, valid or not
+        self.size:int = 0                   # bytes written to the entry
+
+        self._name:str = None               # state of the part being received
+        self._head = bytearray()
+        self._out:typing.BinaryIO = None
+        self._skip:bool = True
+        self._part_size:int = 0
+
+
+    def receive(self) -> typing.List[str]:
+        """ Reads the whole request. Returns the names of the received files.
+        """
+
+        # the decoder buffers at most a chunk plus an unparsed tail, unless the part headers are bogus
+        decoder = MultipartDecoder(self.boundary, max_form_memory_size=2 * UPLOAD_CHUNK_SIZE)
+
+        try:
+            while True:
+                chunk = self.stream.read(UPLOAD_CHUNK_SIZE)
+                decoder.receive_data(chunk or None)
+
+                event = decoder.next_event()
+                while not isinstance(event, NeedData):
+                    if isinstance(event, File):
+                        self._start_part(event.filename)
+                    elif isinstance(event, Field):
+                        # a plain form field, its data is dropped like a file part without a name
+                        self._start_part('')
+                    elif isinstance(event, Data):
+                        self._receive_data(event.data, event.more_data)
+                    elif isinstance(event, Epilogue):
+                        return self.files
+                    event = decoder.next_event()
+
+                if not chunk:
+                    raise BadRequest('Incomplete upload')
+
+        except ValueError as e:
+            # malformed multipart body
+            self.discard()
+            raise BadRequest(str(e))
+
+        except Exception:
+            self.discard()
+            raise
+
+
+    def commit(self) -> typing.List[str]:
+        """ Makes the received files visible to the kiosk under their final names.
+        """
+
+        file_names = []
+
+        for part_name in self.files:
+            file_name = part_name[:-len(PART_SUFFIX)]
+            os.replace(os.path.join(self.entry.entry_path, part_name),
+                       os.path.join(self.entry.entry_path, file_name))
+            file_names.append(file_name)
+
+        return file_names
+
+
+    def discard(self) -> None:
+        """ Removes everything written so far, including the Entry.
+        """
+
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+        if self.entry is not None:
+            shutil.rmtree(self.entry.entry_path, ignore_errors=True)
+            registry.remove_entry(self.entry.genStr)
+            code_allocator.release(self.entry.genStr)
+            logger.info(f'Upload to \'{self.entry.genStr}\' discarded')
+            self.entry = None
+
+
+    def _start_part(self, filename:str) -> None:
+        self._name = filename
+        self._head = bytearray()
+        self._skip = filename == ''
+        self._part_size = 0
+
+        if not self._skip:
+            self.parts += 1
+
+
+    def _receive_data(self, data:bytes, more_data:bool) -> None:
+
+        if self._skip:
+            return
+
+        self._part_size += len(data)
+        if self._part_size > UPLOAD_MAX_FILE_SIZE:
+            raise RequestEntityTooLarge(f'\'{self._name}\' is larger than {UPLOAD_MAX_FILE_SIZE} bytes')
+
+        if self._out is None:
+            self._head += data
+            if len(self._head) < UPLOAD_SNIFF_SIZE and more_data:
+                return
+
+            f_type = sniff_type(bytes(self._head))
+            if f_type is None:
+                logger.info(f'Upload of \'{self._name}\' rejected, unsupported file type')
+                self._skip = True
+                return
+
+            self._open(upload_name(self._name, f_type))
+            data = bytes(self._head)
+            self._head = bytearray()
+
+        self.size += len(data)
+        if self.size > UPLOAD_MAX_ENTRY_SIZE:
+            raise RequestEntityTooLarge(f'Upload is larger than {UPLOAD_MAX_ENTRY_SIZE} bytes')
+
+        self._out.write(data)
+
+        if not more_data:
+            self._out.close()
+            self._out = None
+            logger.debug(f'Received \'{self.files[-1]}\', {self._part_size} bytes')
+
+
+    def _open(self, file_name:str) -> None:
+
+        if self.entry is None:
+            self.entry = Entry()
+
+        # several files with the same name in one upload are kept apart
+        name, ext = os.path.splitext(file_name)
+        counter = 1
+        while file_name + PART_SUFFIX in self.files:
+            counter += 1
+            file_name = f'{name}-{counter}{ext}'
+
+        self.files.append(file_name + PART_SUFFIX)
+        self._out = open(os.path.join(self.entry.entry_path, file_name + PART_SUFFIX), 'wb')
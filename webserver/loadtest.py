@@ -0,0 +1,105 @@
+""" Local load test of the upload endpoint. M concurrent clients each post
+    a number of uploads of N files and the throughput and latencies are reported.
+
+    python3 webserver/loadtest.py --clients 8 --requests 5 --files 3 tmp/TEST1NG/pexels-pixabay-147411.jpg
+
+    Every upload creates an entry (and conversion jobs) like a real one would.
+"""
+
+import argparse
+import http.client
+import os
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+def multipart_body(f_paths:list, files:int) -> tuple:
+    """ Returns the content type and the body of a form with files copies of the files.
+    """
+
+    boundary = uuid.uuid4().hex
+    body = bytearray()
+
+    for i in range(files):
+        f_path = f_paths[i % len(f_paths)]
+        with open(f_path, 'rb') as f:
+            data = f.read()
+
+        body += (f'--{boundary}\r\n'
+                 f'Content-Disposition: form-data; name="files"; filename="{i}-{os.path.basename(f_path)}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        body += data + b'\r\n'
+
+    body += f'--{boundary}--\r\n'.encode()
+
+    return f'multipart/form-data; boundary={boundary}', bytes(body)
+
+
+def upload(host:str, port:int, content_type:str, body:bytes) -> tuple:
+    """ Posts one upload, returns (status, seconds).
+    """
+
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection(host, port, timeout=120)
+
+    try:
+        conn.request('POST', '/upload', body=body, headers={'Content-Type': content_type})
+        response = conn.getresponse()
+        response.read()
+        status = response.status
+    except OSError:
+        status = None
+    finally:
+        conn.close()
+
+    return status, time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Upload load test')
+    parser.add_argument('f_paths', nargs='+', help='files to upload')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients (M)')
+    parser.add_argument('--requests', type=int, default=5, help='uploads per client')
+    parser.add_argument('--files', type=int, default=1, help='files per upload (N)')
+    args = parser.parse_args()
+
+    content_type, body = multipart_body(args.f_paths, args.files)
+    results = []
+    lock = threading.Lock()
+
+    def client() -> None:
+        for _ in range(args.requests):
+            result = upload(args.host, args.port, content_type, body)
+            with lock:
+                results.append(result)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        for _ in range(args.clients):
+            executor.submit(client)
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(seconds for status, seconds in results if status == 200)
+    failed = len(results) - len(latencies)
+
+    print(f'{len(results)} uploads of {args.files} file(s), {len(body) / 2**20:.2f} MB each, '
+          f'{args.clients} clients, {elapsed:.2f} s')
+    print(f'failed: {failed}')
+
+    if latencies:
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        print(f'throughput: {len(latencies) / elapsed:.2f} uploads/s, '
+              f'{len(latencies) * args.files / elapsed:.2f} files/s, '
+              f'{len(latencies) * len(body) / 2**20 / elapsed:.2f} MB/s')
+        print(f'latency: p50 {statistics.median(latencies) * 1000:.0f} ms, '
+              f'p95 {p95 * 1000:.0f} ms, max {latencies[-1] * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,25 @@ import sys
 import os
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
 from constants import *
-from rand import Entry
+from rand import expiry_scheduler, code_allocator
+from storage import storage
+from conversion import ConversionPool
+from uploads import UploadReceiver, PART_SUFFIX
 
-from flask import Flask, render_template, request, redirect, url_for
-from werkzeug.utils import secure_filename
-import base64
-import io
+from flask import Flask, render_template, request, redirect, url_for, jsonify, abort
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from logger import logger
+import signal
 
 app = Flask(__name__)
 
 app.config['DEBUG'] = True if DEBUG is True else False
-app.config['MAX_CONTENT_LENGTH'] = 25 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_ENTRY_SIZE
+
+conversion_pool = ConversionPool()
+
+QR_MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
 
 @app.route('/')
 def index():
@@ -20,37 +28,159 @@ def index():
 
 @app.route('/upload', methods = ['POST'])
 def upload():
-    uploaded_files = request.files.getlist('files')
-    valid_files_index = []
-
-    for index, each in enumerate(uploaded_files):
-        if each.filename == '':
-            return redirect('/')
-        if any(each.filename.endswith('.' + ext) for ext in FILE_TYPES):
-            valid_files_index.append(index)
-
-    if valid_files_index:
-        entry = Entry()
-        qr = entry.qr
+    if request.mimetype != 'multipart/form-data' or 'boundary' not in request.mimetype_params:
+        return redirect('/')
+
+    # a chunked upload has no Content-Length, the largest one allowed is assumed
+    upload_size = min(request.content_length or UPLOAD_MAX_ENTRY_SIZE, UPLOAD_MAX_ENTRY_SIZE)
+    if not storage.admit(upload_size):
+        return 'The printer is out of storage space, please try again later', 507
+
+    try:
+        # request.stream refuses a Content-Length over MAX_CONTENT_LENGTH before anything is read
+        receiver = UploadReceiver(request.stream, request.mimetype_params['boundary'].encode())
+        part_names = receiver.receive()
+    finally:
+        storage.release(upload_size)
+
+    if receiver.parts == 0:
+        return redirect('/')
+
+    if part_names:
+        entry = receiver.entry
         genStr = entry.genStr
-        buf = io.BytesIO()
-        qr.save(buf, format='PNG')
-        # buf.seek(0)
-        qr_base64 = base64.b64encode(buf.getvalue()).decode('utf-8')
-
-        for each in valid_files_index:
-            uploaded_files[each].save(
-                os.path.join(ENTRIES_FPATH, genStr, secure_filename(
-                    uploaded_files[each].filename)))
+
+        file_names = [part_name[:-len(PART_SUFFIX)] for part_name in part_names]
+
+        # the status is recorded before the files are visible so the kiosk never converts them itself
+        conversion_pool.mark_pending(entry.entry_path, file_names)
+        receiver.commit()
+        storage.refresh(entry.entry_path)
+        conversion_pool.submit(entry.entry_path, file_names)
         
-        return render_template('upload.html', qr_base64=qr_base64, genStr=genStr)
+        # the QR image is precomputed and served by qr(), the page only links it
+        return render_template('upload.html', qr_url=url_for('qr', token=code_allocator.qr_token(genStr)), genStr=genStr)
     else:
         return 'No valid files found'
 
+
+@app.route('/qr/<token>')
+def qr(token):
+    # unknown tokens and released codes get the same answer
+    code = code_allocator.code_of(token)
+    qr_image = code_allocator.qr_image(code) if code is not None else None
+    if qr_image is None:
+        abort(404)
+
+    response = app.response_class(qr_image, mimetype=QR_MIMETYPES[QR_FORMAT])
+    # the image of a code never changes, browsers may keep it for the life of the entry
+    response.headers['Cache-Control'] = f'private, max-age={ENTRY_RM_INTERVAL}, immutable'
+    response.set_etag(token)
+
+    return response.make_conditional(request)
+
+
+@app.route('/stats')
+def stats():
+    return jsonify(dict(expiry_scheduler.stats(), **conversion_pool.stats()))
+
     
 @app.errorhandler(413)
 def request_entity_too_large(error):
-    return f'Maximum upload size is 25 MB', 413
+    return (f'Maximum upload size is {UPLOAD_MAX_FILE_SIZE // (1024 * 1024)} MB per file '
+            f'and {UPLOAD_MAX_ENTRY_SIZE // (1024 * 1024)} MB in total'), 413
+
+
+class RequestHandler(WSGIRequestHandler):
+    # one request per connection, an idle keep-alive client would otherwise hold a worker
+    protocol_version = 'HTTP/1.0'
+    timeout = 30                # seconds, drops the clients that stop sending mid-upload
+
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """ WSGI server that handles the requests on a fixed pool of worker threads,
+        so a few slow uploads don't block the others and a burst can't start
+        an unbounded number of threads.
+    """
+
+    multithread = True
+
+
+    def __init__(self, host:str, port:int, app, workers:int = WEBSERVER_THREADS):
+        super().__init__(host, port, app, handler=RequestHandler)
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http')
+
+
+    def process_request(self, request, client_address) -> None:
+        self.workers.submit(self._process_request, request, client_address)
+
+
+    def server_close(self) -> None:
+        """ Stops accepting connections and waits for the requests in progress.
+        """
+
+        super().server_close()
+        self.workers.shutdown(wait=True)
+
+
+    def _process_request(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+
+def serve(mode:str = WEBSERVER_MODE) -> None:
+    """ Runs the webserver until SIGTERM (sent by the kiosk on exit) or Ctrl+C, then
+        finishes the requests and conversions in progress. The queued conversions are
+        cancelled and left to the kiosk.
+    """
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    expiry_scheduler.start()
+    code_allocator.start()
+
+    if mode == 'waitress':
+        try:
+            import waitress
+        except ImportError:
+            logger.info('waitress is not installed, using the threaded server')
+            mode = 'threaded'
+
+    logger.info(f'Webserver listening on {WEBSERVER_HOST}:{WEBSERVER_PORT}, {mode} mode')
+
+    try:
+        if mode == 'waitress':
+            server = waitress.create_server(app, host=WEBSERVER_HOST, port=WEBSERVER_PORT,
+                                            threads=WEBSERVER_THREADS)
+            try:
+                server.run()
+            finally:
+                server.close()
+
+        elif mode == 'threaded':
+            # serve_forever() calls server_close() on the way out
+            PooledWSGIServer(WEBSERVER_HOST, WEBSERVER_PORT, app).serve_forever()
+
+        else:
+            app.run(port=WEBSERVER_PORT, host=WEBSERVER_HOST)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        logger.info('Webserver stopping')
+        expiry_scheduler.stop()
+        conversion_pool.shutdown(wait=True, cancel_futures=True)
 
 
-app.run(port=8080, host='0.0.0.0')
\ No newline at end of file
+# the conversion workers are spawned processes that import this module again
+if __name__ == '__main__':
+    serve()
\ No newline at end of file